@@ -0,0 +1,49 @@
+"""
+Async database access for the aiogram handlers:
+- asyncpg-backed SQLAlchemy engine on the same DATABASE_URL, with an
+  explicit pool (DB_POOL_SIZE + DB_MAX_OVERFLOW connections per process)
+- DbSessionMiddleware gives every update one AsyncSession as the `db`
+  handler argument and always closes it, also when the handler raises;
+  the session takes a pool connection only on its first query
+- a handler that then waits on slow non-database work (e.g. /sync) commits
+  first, so its connection goes back to the pool meanwhile
+- helpers shared with the sync services (refresh_next_reminders, notify)
+  run on the session through AsyncSession.run_sync
+
+Background jobs (scheduler, sync queue, outbox) keep the sync engine in
+database.py and run in worker threads.
+"""
+import os
+from aiogram import BaseMiddleware
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from database import DATABASE_URL
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = 1800  # seconds
+
+async_engine = create_async_engine(
+    make_url(DATABASE_URL).set(drivername='postgresql+asyncpg'),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True
+)
+# Objects stay readable after commit, handlers render them afterwards
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """One AsyncSession per update, passed to handlers as `db`"""
+
+    async def __call__(self, handler, event, data):
+        async with AsyncSessionLocal() as session:
+            data['db'] = session
+            return await handler(event, data)
+
+
+async def dispose():
+    await async_engine.dispose()
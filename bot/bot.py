@@ -1,23 +1,43 @@
 import asyncio
 import os
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from datetime import datetime
-from database import init_db, get_db, User, Deadline, Coursework
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import (
+    init_db, User, Deadline, Coursework, UserSettings, refresh_next_reminders, notify, DEADLINES_CHANGED, USER_CHANGED,
+    REMINDER_OFFSETS, DEFAULT_REMINDER_OFFSETS
+)
 from google_auth import get_authorization_url
 from google.auth.exceptions import RefreshError
+from classroom_client import CircuitOpenError
+from sync_queue import lease_user, release_lease, run_leased, INTERACTIVE_FRESHNESS
+from scheduler import start_scheduler, set_bot_instance, reminders
+from deadline_pages import deadline_page, page_cache, ACTIVE, OVERDUE, DEADLINES_PER_PAGE
+from async_db import DbSessionMiddleware, dispose
+from identity import IdentityMiddleware, identity_cache, load_identity
+from state_store import StateStorage, state_store, COURSES, ALL_COURSES, COURSES_TTL
+from webhook import run_webhook
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# polling - один процесс; webhook - апдейты приходят на aiohttp-сервер, реплик может быть несколько
+BOT_MODE = os.getenv("BOT_MODE", "polling")
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Состояние диалогов ограничено по размеру и времени; STATE_BACKEND=postgres - общее для реплик
+storage = StateStorage(state_store)
 dp = Dispatcher(storage=storage)
+# Каждый апдейт получает свою AsyncSession (аргумент db) и пользователя (аргумент user)
+dp.update.middleware(DbSessionMiddleware())
+dp.update.middleware(IdentityMiddleware())
 
-# Количество дедлайнов на странице
-DEADLINES_PER_PAGE = 5
+# Единицы в /reminders: 7d 2d 6h 30m (в минутах)
+REMINDER_UNITS = {'d': 24 * 60, 'h': 60, 'm': 1}
+REMINDER_CHOICES = sorted((int(offset.total_seconds()) // 60 for _, offset in REMINDER_OFFSETS), reverse=True)
 
 
 # FSM States для добавления дедлайна
@@ -49,19 +69,14 @@ def get_main_keyboard():
 
 
 @dp.message(CommandStart())
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, db: AsyncSession, user):
     telegram_id = message.from_user.id
     username = message.from_user.username
 
-    db = get_db()
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-
     if not user:
-        user = User(telegram_id=telegram_id, username=username)
-        db.add(user)
-        db.commit()
-
-    db.close()
+        db.add(User(telegram_id=telegram_id, username=username))
+        await db.commit()
+        await load_identity(db, telegram_id)
 
     await message.answer(
         "👋 Привіт! Я бот для нагадувань про дедлайни з Google Classroom.\n\n"
@@ -69,7 +84,8 @@ async def cmd_start(message: types.Message):
         "/connect - Підключити Google Classroom\n"
         "/deadlines - Показати актуальні дедлайни\n"
         "/courses - Вибрати предмет\n"
-        "/sync - Синхронізувати дедлайни\n\n"
+        "/sync - Синхронізувати дедлайни\n"
+        "/reminders - Налаштувати нагадування\n\n"
         "Використовуй кнопки внизу для швидкого доступу! 👇",
         reply_markup=get_main_keyboard()
     )
@@ -91,182 +107,44 @@ async def cmd_connect(message: types.Message):
 
 
 @dp.message(Command("deadlines"))
-async def cmd_deadlines(message: types.Message):
+async def cmd_deadlines(message: types.Message, db: AsyncSession, user):
     """Показать актуальные дедлайны с пагинацией"""
-    telegram_id = message.from_user.id
-    await show_deadlines_page(message, telegram_id, page=0)
+    await show_deadlines_page(message, db, user, page=0)
 
 
-async def show_deadlines_page(message: types.Message, telegram_id: int, page: int = 0):
+async def show_deadlines_page(message: types.Message, db: AsyncSession, user, page: int = 0):
     """Показать страницу дедлайнов"""
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        await message.answer("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
-        return
-    
-    now = datetime.utcnow()
-
-    deadlines = db.query(Deadline).filter(
-        Deadline.user_id == user.id,
-        Deadline.due_date >= now
-    ).order_by(Deadline.due_date).all()
-
-    db.close()
-
-    if not deadlines:
-        await message.answer("📭 У вас немає актуальних дедлайнів.")
-        return
-
-    # Пагинация
-    total_pages = (len(deadlines) - 1) // DEADLINES_PER_PAGE + 1
-    page = max(0, min(page, total_pages - 1))
-
-    start_idx = page * DEADLINES_PER_PAGE
-    end_idx = start_idx + DEADLINES_PER_PAGE
-    page_deadlines = deadlines[start_idx:end_idx]
-
-    text = f"📚 <b>Актуальні дедлайни ({page + 1}/{total_pages}):</b>\n\n"
-
-    for dl in page_deadlines:
-        time_left = dl.due_date - now
-        days_left = time_left.days
-        hours_left = time_left.seconds // 3600
-
-        text += f"📝 <b>{dl.title}</b>\n"
-        text += f"📖 {dl.course_name}\n"
-        text += f"⏰ {dl.due_date.strftime('%d.%m.%Y %H:%M')}\n"
-
-        if days_left > 0:
-            text += f"⏳ Залишилось: {days_left} д. {hours_left} год.\n"
-        else:
-            text += f"⏳ Залишилось: {hours_left} год.\n"
-
-        if dl.link:
-            text += f"🔗 <a href='{dl.link}'>Відкрити</a>\n"
-        text += "\n"
-
-    # Кнопки навигации
-    keyboard = []
-    nav_buttons = []
-
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"dl_page_{page - 1}"))
-
-    nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore"))
-
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"dl_page_{page + 1}"))
-
-    keyboard.append(nav_buttons)
-
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-
+    text, reply_markup = await deadline_page(db, user, ACTIVE, page)
     await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
 @dp.callback_query(F.data.startswith("dl_page_"))
-async def process_deadlines_page(callback_query: types.CallbackQuery):
+async def process_deadlines_page(callback_query: types.CallbackQuery, db: AsyncSession, user):
     """Обработка переключения страниц дедлайнов"""
     await callback_query.answer()
 
     page = int(callback_query.data.replace("dl_page_", ""))
-    telegram_id = callback_query.from_user.id
-
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        await callback_query.message.edit_text("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
-        return
-    
-    now = datetime.utcnow()
-
-    # Получаем ТОЛЬКО активные дедлайны
-    deadlines = db.query(Deadline).filter(
-        Deadline.user_id == user.id,
-        Deadline.due_date >= now
-    ).order_by(Deadline.due_date).all()
-
-    db.close()
-
-    if not deadlines:
-        await callback_query.message.edit_text("📭 У вас немає активних дедлайнів.")
-        return
-
-    # Пагинация
-    total_pages = (len(deadlines) - 1) // DEADLINES_PER_PAGE + 1
-    page = max(0, min(page, total_pages - 1))
-
-    start_idx = page * DEADLINES_PER_PAGE
-    end_idx = start_idx + DEADLINES_PER_PAGE
-    page_deadlines = deadlines[start_idx:end_idx]
-
-    text = f"📚 <b>Активні дедлайни ({page + 1}/{total_pages}):</b>\n\n"
-
-    for dl in page_deadlines:
-        time_left = dl.due_date - now
-        days_left = time_left.days
-        hours_left = time_left.seconds // 3600
-
-        text += f"✅ <b>{dl.title}</b>\n"
-        text += f"📖 {dl.course_name}\n"
-        text += f"⏰ {dl.due_date.strftime('%d.%m.%Y %H:%M')}\n"
-
-        if days_left > 0:
-            text += f"⏳ Залишилось: {days_left} д. {hours_left} год.\n"
-        else:
-            text += f"⏳ Залишилось: {hours_left} год.\n"
-
-        if dl.link:
-            text += f"🔗 <a href='{dl.link}'>Відкрити</a>\n"
-        text += "\n"
-
-    # Кнопки навигации
-    keyboard = []
-    nav_buttons = []
-
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"dl_page_{page - 1}"))
-
-    nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore"))
-
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"dl_page_{page + 1}"))
-
-    keyboard.append(nav_buttons)
-
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-
+    text, reply_markup = await deadline_page(db, user, ACTIVE, page)
     await callback_query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
 @dp.message(Command("courses"))
-async def cmd_courses(message: types.Message):
+async def cmd_courses(message: types.Message, db: AsyncSession, user):
     """Показать список предметов"""
     telegram_id = message.from_user.id
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
+
     if not user:
         await message.answer("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
         return
 
     # Получаем список всех курсов из кеша или из базы данных
-    if hasattr(bot, 'all_courses_cache') and telegram_id in bot.all_courses_cache:
-        all_courses_list = bot.all_courses_cache[telegram_id]
-    else:
+    all_courses_list = await state_store.get(ALL_COURSES, telegram_id)
+    if all_courses_list is None:
         # Fallback: получаем только курсы с дедлайнами из базы
-        courses_db = db.query(Deadline.course_name).filter(
-            Deadline.user_id == user.id
-        ).distinct().all()
-        all_courses_list = [c[0] for c in courses_db]
-
-    db.close()
+        courses_db = await db.scalars(
+            select(Deadline.course_name).where(Deadline.user_id == user.id).distinct()
+        )
+        all_courses_list = courses_db.all()
 
     if not all_courses_list:
         await message.answer("📭 У вас ще немає курсів. Спочатку виконайте /sync")
@@ -285,9 +163,7 @@ async def cmd_courses(message: types.Message):
         ])
 
     # Сохраняем курсы в кеш для обработки callback
-    if not hasattr(bot, 'courses_cache'):
-        bot.courses_cache = {}
-    bot.courses_cache[telegram_id] = all_courses_list
+    await state_store.set(COURSES, telegram_id, all_courses_list, COURSES_TTL)
 
     reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
 
@@ -300,14 +176,14 @@ async def cmd_courses(message: types.Message):
 
 # Обработчик кнопки "📖 Курси"
 @dp.message(F.text == "📖 Курси")
-async def show_courses_button(message: types.Message):
+async def show_courses_button(message: types.Message, db: AsyncSession, user):
     """Показать список предметов через кнопку"""
     # Переиспользуем логику команды /courses
-    await cmd_courses(message)
+    await cmd_courses(message, db, user)
 
 
 @dp.callback_query(F.data.startswith("c_"))
-async def process_course_callback(callback_query: types.CallbackQuery):
+async def process_course_callback(callback_query: types.CallbackQuery, db: AsyncSession, user):
     """Обработка выбора курса с пагинацией"""
     await callback_query.answer()
 
@@ -317,39 +193,36 @@ async def process_course_callback(callback_query: types.CallbackQuery):
 
     telegram_id = callback_query.from_user.id
 
-    if not hasattr(bot, 'courses_cache') or telegram_id not in bot.courses_cache:
+    courses_list = await state_store.get(COURSES, telegram_id)
+    if courses_list is None:
         await callback_query.message.answer("❌ Помилка. Спробуйте /courses ще раз.")
         return
-
-    courses_list = bot.courses_cache[telegram_id]
     if course_idx >= len(courses_list):
         await callback_query.message.answer("❌ Предмет не знайдено.")
         return
 
     course_name = courses_list[course_idx]
 
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
     if not user:
         await callback_query.message.answer("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
         return
     
     now = datetime.utcnow()
 
-    all_deadlines = db.query(Deadline).filter(
-        Deadline.user_id == user.id,
-        Deadline.course_name == course_name
-    ).order_by(Deadline.due_date).all()
+    all_deadlines = (await db.scalars(
+        select(Deadline).where(
+            Deadline.user_id == user.id,
+            Deadline.course_name == course_name
+        ).order_by(Deadline.due_date)
+    )).all()
     
     # Получаем coursework без дедлайнов
-    all_coursework = db.query(Coursework).filter(
-        Coursework.user_id == user.id,
-        Coursework.course_name == course_name
-    ).all()
-
-    db.close()
+    all_coursework = (await db.scalars(
+        select(Coursework).where(
+            Coursework.user_id == user.id,
+            Coursework.course_name == course_name
+        )
+    )).all()
 
     if not all_deadlines and not all_coursework:
         await callback_query.message.answer("📭 Дедлайнів не знайдено.")
@@ -443,12 +316,11 @@ async def back_to_courses(callback_query: types.CallbackQuery):
 
     telegram_id = callback_query.from_user.id
 
-    if not hasattr(bot, 'courses_cache') or telegram_id not in bot.courses_cache:
+    courses_list = await state_store.get(COURSES, telegram_id)
+    if courses_list is None:
         await callback_query.message.answer("❌ Помилка. Спробуйте /courses ще раз.")
         return
 
-    courses_list = bot.courses_cache[telegram_id]
-
     keyboard = []
     for idx, course_name in enumerate(courses_list):
         display_name = course_name[:45] + "..." if len(course_name) > 45 else course_name
@@ -475,15 +347,28 @@ async def ignore_callback(callback_query: types.CallbackQuery):
 
 
 @dp.message(Command("sync"))
-async def cmd_sync(message: types.Message):
+async def cmd_sync(message: types.Message, db: AsyncSession, user):
     telegram_id = message.from_user.id
-    db = get_db()
-
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
 
-    if not user or not user.google_token:
+    if not user or not user.has_token:
         await message.answer("⚠️ Спочатку підключіть Google Classroom (/connect)")
-        db.close()
+        return
+    google_token = await db.scalar(select(User.google_token).where(User.id == user.id))
+    # Синхронизация идет минуту: не держим соединение пула все это время
+    await db.commit()
+
+    # Checker и авто-синхронизация пишут в ту же очередь: не синхронизируем повторно
+    leased, last_synced_at = await asyncio.to_thread(lease_user, user.id)
+    if not leased:
+        await message.answer("🔄 Синхронізація вже виконується, дані оновляться за хвилину.")
+        return
+    if last_synced_at and datetime.utcnow() - last_synced_at < INTERACTIVE_FRESHNESS:
+        await asyncio.to_thread(release_lease, user.id)
+        minutes = int((datetime.utcnow() - last_synced_at).total_seconds() // 60)
+        await message.answer(
+            f"✅ Дедлайни вже актуальні (синхронізовано {minutes} хв тому).\n"
+            f"Використайте кнопку '📚 Дедлайни' для перегляду!"
+        )
         return
 
     await message.answer("🔄 Синхронізація... Це може зайняти хвилину.")
@@ -491,12 +376,19 @@ async def cmd_sync(message: types.Message):
     # Выполняем синхронизацию
     try:
         from classroom_sync import sync_user_deadlines
-        added_count, updated_count, all_courses = sync_user_deadlines(user.id, telegram_id, user.google_token)
+        # Запросы к Google блокирующие - выполняем вне event loop
+        added_count, updated_count, all_courses = await run_leased(
+            user.id,
+            lambda: asyncio.to_thread(sync_user_deadlines, user.id, telegram_id, google_token),
+            count_changes=lambda result: result[0] + result[1]
+        )
         
+        if added_count or updated_count:
+            page_cache.invalidate(user.id)
+            await reminders.refresh_user(user.id)
+
         # Сохраняем список всех курсов в кеш
-        if not hasattr(bot, 'all_courses_cache'):
-            bot.all_courses_cache = {}
-        bot.all_courses_cache[telegram_id] = all_courses
+        await state_store.set(ALL_COURSES, telegram_id, all_courses, COURSES_TTL)
         
         await message.answer(
             f"✅ Синхронізація завершена!\n"
@@ -505,11 +397,18 @@ async def cmd_sync(message: types.Message):
             f"📚 Знайдено курсів: {len(all_courses)}\n\n"
             f"Використайте кнопку '📚 Дедлайни' для перегляду!"
         )
+    except CircuitOpenError:
+        await message.answer(
+            "⏸ Google Classroom зараз недоступний або перевантажений.\n"
+            "Синхронізацію призупинено, спробуйте трохи пізніше."
+        )
     except RefreshError:
         print(f"❌ Token expired for user {telegram_id}")
         # Инвалидируем токен
-        user.google_token = None
-        db.commit()
+        await db.execute(update(User).where(User.id == user.id).values(google_token=None))
+        await db.run_sync(notify, USER_CHANGED, user.id)
+        await db.commit()
+        identity_cache.invalidate(user.id)
         
         await message.answer(
             "⚠️ <b>Термін дії доступу минув!</b>\n\n"
@@ -526,238 +425,110 @@ async def cmd_sync(message: types.Message):
             f"Деталі: {str(e)}\n\n"
             f"Спробуйте ще раз або зверніться до адміністратора."
         )
-    finally:
-        db.close()
 
 
-# Обработчик кнопки "🔄 Синхронізація"
-@dp.message(F.text == "🔄 Синхронізація")
-async def sync_button_handler(message: types.Message):
-    """Синхронізація через кнопку"""
-    await cmd_sync(message)
+def _format_offset(minutes: int) -> str:
+    if minutes % REMINDER_UNITS['d'] == 0:
+        return f"{minutes // REMINDER_UNITS['d']} д."
+    if minutes % REMINDER_UNITS['h'] == 0:
+        return f"{minutes // REMINDER_UNITS['h']} год."
+    return f"{minutes} хв."
 
 
-# Обработчик кнопки "📚 Дедлайни" (только активные дедлайны)
-@dp.message(F.text == "📚 Дедлайни")
-async def show_active_deadlines(message: types.Message):
-    """Показать активные дедлайны"""
-    telegram_id = message.from_user.id
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        await message.answer("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
-        return
-    
-    now = datetime.utcnow()
+def _parse_offsets(args: str):
+    """'7d 2d 6h 30m' -> [10080, 2880, 360, 30]; None если есть недопустимое значение"""
+    offsets = set()
+    for token in args.lower().replace(',', ' ').split():
+        number, unit = token[:-1], token[-1:]
+        if not number.isdigit() or unit not in REMINDER_UNITS:
+            return None
+        minutes = int(number) * REMINDER_UNITS[unit]
+        if minutes not in REMINDER_CHOICES:
+            return None
+        offsets.add(minutes)
+    return sorted(offsets, reverse=True)
 
-    # Получаем ТОЛЬКО активные дедлайны
-    deadlines = db.query(Deadline).filter(
-        Deadline.user_id == user.id,
-        Deadline.due_date >= now
-    ).order_by(Deadline.due_date).all()
 
-    db.close()
+@dp.message(Command("reminders"))
+async def cmd_reminders(message: types.Message, command: CommandObject, db: AsyncSession, user):
+    """Показать или задать, за сколько до дедлайна напоминать"""
+    args = (command.args or "").strip()
 
-    if not deadlines:
-        await message.answer("📭 У вас немає активних дедлайнів.")
-        return
-
-    # Пагинация
-    total_pages = (len(deadlines) - 1) // DEADLINES_PER_PAGE + 1
-    page = 0
-
-    start_idx = page * DEADLINES_PER_PAGE
-    end_idx = start_idx + DEADLINES_PER_PAGE
-    page_deadlines = deadlines[start_idx:end_idx]
-
-    text = f"📚 <b>Активні дедлайни ({page + 1}/{total_pages}):</b>\n\n"
-
-    for dl in page_deadlines:
-        time_left = dl.due_date - now
-        days_left = time_left.days
-        hours_left = time_left.seconds // 3600
-
-        text += f"✅ <b>{dl.title}</b>\n"
-        text += f"📖 {dl.course_name}\n"
-        text += f"⏰ {dl.due_date.strftime('%d.%m.%Y %H:%M')}\n"
-
-        if days_left > 0:
-            text += f"⏳ Залишилось: {days_left} д. {hours_left} год.\n"
-        else:
-            text += f"⏳ Залишилось: {hours_left} год.\n"
-
-        if dl.link:
-            text += f"🔗 <a href='{dl.link}'>Відкрити</a>\n"
-        text += "\n"
-
-    # Кнопки навигации
-    keyboard = []
-    nav_buttons = []
-
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"dl_page_{page - 1}"))
-
-    nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore"))
-
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"dl_page_{page + 1}"))
-
-    keyboard.append(nav_buttons)
-
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-
-    await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
-
-
-# Обработчик кнопки "❌ Прострочені" (просроченные дедлайны)
-@dp.message(F.text == "❌ Прострочені")
-async def show_overdue_deadlines(message: types.Message):
-    """Показать просроченные дедлайны"""
-    telegram_id = message.from_user.id
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
     if not user:
         await message.answer("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
         return
-    
-    now = datetime.utcnow()
-
-    deadlines = db.query(Deadline).filter(
-        Deadline.user_id == user.id,
-        Deadline.due_date < now
-    ).order_by(Deadline.due_date.desc()).all()
-
-    db.close()
 
-    if not deadlines:
-        await message.answer("✅ У вас немає прострочених дедлайнів!")
+    if not args:
+        settings = await db.scalar(select(UserSettings).where(UserSettings.user_id == user.id))
+        offsets = settings.reminder_offsets if settings and settings.reminder_offsets is not None else DEFAULT_REMINDER_OFFSETS
+        current = ", ".join(_format_offset(m) for m in sorted(offsets, reverse=True)) or "вимкнено"
+        await message.answer(
+            f"🔔 Нагадування: {current}\n\n"
+            f"Змінити: /reminders 7d 2d 6h 30m\n"
+            f"Доступно: {' '.join(_format_offset(m) for m in REMINDER_CHOICES)}\n"
+            f"/reminders off - вимкнути, /reminders default - за замовчуванням"
+        )
         return
 
-    # Пагинация
-    total_pages = (len(deadlines) - 1) // DEADLINES_PER_PAGE + 1
-    page = 0
-
-    start_idx = page * DEADLINES_PER_PAGE
-    end_idx = start_idx + DEADLINES_PER_PAGE
-    page_deadlines = deadlines[start_idx:end_idx]
-
-    text = f"❌ <b>Прострочені дедлайни ({page + 1}/{total_pages}):</b>\n\n"
-
-    for dl in page_deadlines:
-        time_ago = now - dl.due_date
-        days_ago = time_ago.days
-        hours_ago = time_ago.seconds // 3600
+    if args.lower() == "off":
+        offsets = []
+    elif args.lower() == "default":
+        offsets = None
+    else:
+        offsets = _parse_offsets(args)
+        if not offsets:
+            await message.answer(
+                "❌ Невірний формат. Приклад: /reminders 7d 2d 6h 30m\n"
+                f"Доступно: {' '.join(_format_offset(m) for m in REMINDER_CHOICES)}"
+            )
+            return
 
-        text += f"📝 {dl.title}\n"
-        text += f"📖 {dl.course_name}\n"
-        text += f"⏰ Був: {dl.due_date.strftime('%d.%m.%Y %H:%M')}\n"
+    await db.execute(
+        insert(UserSettings).values(user_id=user.id, reminder_offsets=offsets).on_conflict_do_update(
+            index_elements=[UserSettings.user_id], set_={'reminder_offsets': offsets}
+        )
+    )
+    await db.run_sync(refresh_next_reminders, user_id=user.id)
+    await db.run_sync(notify, DEADLINES_CHANGED, user.id)
+    await db.commit()
 
-        if days_ago > 0:
-            text += f"⌛ Прострочено: {days_ago} д. {hours_ago} год. тому\n"
-        else:
-            text += f"⌛ Прострочено: {hours_ago} год. тому\n"
+    await reminders.refresh_user(user.id)
+    if offsets is None:
+        offsets = DEFAULT_REMINDER_OFFSETS
+    current = ", ".join(_format_offset(m) for m in offsets) or "вимкнено"
+    await message.answer(f"✅ Нагадування: {current}")
 
-        if dl.link:
-            text += f"🔗 <a href='{dl.link}'>Відкрити</a>\n"
-        text += "\n"
 
-    # Кнопки навигации
-    keyboard = []
-    nav_buttons = []
-
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"overdue_page_{page - 1}"))
-
-    nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore"))
+# Обработчик кнопки "🔄 Синхронізація"
+@dp.message(F.text == "🔄 Синхронізація")
+async def sync_button_handler(message: types.Message, db: AsyncSession, user):
+    """Синхронізація через кнопку"""
+    await cmd_sync(message, db, user)
 
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"overdue_page_{page + 1}"))
 
-    keyboard.append(nav_buttons)
+# Обработчик кнопки "📚 Дедлайни" (только активные дедлайны)
+@dp.message(F.text == "📚 Дедлайни")
+async def show_active_deadlines(message: types.Message, db: AsyncSession, user):
+    """Показать активные дедлайны"""
+    await show_deadlines_page(message, db, user, page=0)
 
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+# Обработчик кнопки "❌ Прострочені" (просроченные дедлайны)
+@dp.message(F.text == "❌ Прострочені")
+async def show_overdue_deadlines(message: types.Message, db: AsyncSession, user):
+    """Показать просроченные дедлайны"""
+    text, reply_markup = await deadline_page(db, user, OVERDUE)
     await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
 # Обработчик пагинации для просроченных дедлайнов
 @dp.callback_query(F.data.startswith("overdue_page_"))
-async def process_overdue_page(callback_query: types.CallbackQuery):
+async def process_overdue_page(callback_query: types.CallbackQuery, db: AsyncSession, user):
     """Обработка переключения страниц просроченных дедлайнов"""
     await callback_query.answer()
 
     page = int(callback_query.data.replace("overdue_page_", ""))
-    telegram_id = callback_query.from_user.id
-
-    db = get_db()
-    
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        await callback_query.message.edit_text("❌ Користувача не знайдено. Спробуйте /start")
-        db.close()
-        return
-    
-    now = datetime.utcnow()
-
-    deadlines = db.query(Deadline).filter(
-        Deadline.user_id == user.id,
-        Deadline.due_date < now
-    ).order_by(Deadline.due_date.desc()).all()
-
-    db.close()
-
-    if not deadlines:
-        await callback_query.message.edit_text("✅ У вас немає прострочених дедлайнів!")
-        return
-
-    # Пагинация
-    total_pages = (len(deadlines) - 1) // DEADLINES_PER_PAGE + 1
-    page = max(0, min(page, total_pages - 1))
-
-    start_idx = page * DEADLINES_PER_PAGE
-    end_idx = start_idx + DEADLINES_PER_PAGE
-    page_deadlines = deadlines[start_idx:end_idx]
-
-    text = f"❌ <b>Прострочені дедлайни ({page + 1}/{total_pages}):</b>\n\n"
-
-    for dl in page_deadlines:
-        time_ago = now - dl.due_date
-        days_ago = time_ago.days
-        hours_ago = time_ago.seconds // 3600
-
-        text += f"📝 {dl.title}\n"
-        text += f"📖 {dl.course_name}\n"
-        text += f"⏰ Був: {dl.due_date.strftime('%d.%m.%Y %H:%M')}\n"
-
-        if days_ago > 0:
-            text += f"⌛ Прострочено: {days_ago} д. {hours_ago} год. тому\n"
-        else:
-            text += f"⌛ Прострочено: {hours_ago} год. тому\n"
-
-        if dl.link:
-            text += f"🔗 <a href='{dl.link}'>Відкрити</a>\n"
-        text += "\n"
-
-    # Кнопки навигации
-    keyboard = []
-    nav_buttons = []
-
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"overdue_page_{page - 1}"))
-
-    nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore"))
-
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"overdue_page_{page + 1}"))
-
-    keyboard.append(nav_buttons)
-
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-
+    text, reply_markup = await deadline_page(db, user, OVERDUE, page)
     await callback_query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
@@ -911,14 +682,14 @@ async def proceed_to_link(message: types.Message, state: FSMContext):
 
 
 @dp.callback_query(F.data == "skip_link", AddDeadlineStates.waiting_for_link)
-async def skip_link_callback(callback_query: types.CallbackQuery, state: FSMContext):
+async def skip_link_callback(callback_query: types.CallbackQuery, state: FSMContext, db: AsyncSession, user):
     """Пропуск ввода ссылки"""
     await callback_query.answer()
-    await finalize_deadline(callback_query.message, state, None)
+    await finalize_deadline(callback_query.message, state, db, user, None)
 
 
 @dp.message(AddDeadlineStates.waiting_for_link)
-async def process_deadline_link(message: types.Message, state: FSMContext):
+async def process_deadline_link(message: types.Message, state: FSMContext, db: AsyncSession, user):
     """Обработка ссылки"""
     if message.text == "/cancel":
         await state.clear()
@@ -931,10 +702,10 @@ async def process_deadline_link(message: types.Message, state: FSMContext):
         await message.answer("⚠️ Це не виглядає як посилання. Воно має починатися з http або https.\nСпробуйте ще раз або натисніть 'Пропустити'.")
         return
 
-    await finalize_deadline(message, state, link)
+    await finalize_deadline(message, state, db, user, link)
 
 
-async def finalize_deadline(message: types.Message, state: FSMContext, link: str):
+async def finalize_deadline(message: types.Message, state: FSMContext, db: AsyncSession, user, link: str):
     """Финализация и сохранение дедлайна"""
     data = await state.get_data()
     course_name = data.get('course_name')
@@ -961,14 +732,11 @@ async def finalize_deadline(message: types.Message, state: FSMContext, link: str
     # В случае callback'а message это message объекта callback
     telegram_id = message.chat.id # chat.id надежнее в данном контексте
 
-    db = get_db()
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    
+    # user приходит из IdentityMiddleware по отправителю апдейта
     if not user:
         # Если юзер не найден, возможно он пишет впервые, но команда /start должна была создать
         # Но на всякий случай
         await message.answer("❌ Помилка: користувач не знайдений. Спробуйте /start")
-        db.close()
         await state.clear()
         return
 
@@ -987,10 +755,16 @@ async def finalize_deadline(message: types.Message, state: FSMContext, link: str
     )
 
     db.add(new_deadline)
-    db.commit()
-    db.close()
+    await db.flush()
+    await db.run_sync(refresh_next_reminders, deadline_ids=[new_deadline.id])
+    # Другие реплики бота сбрасывают напоминания и кеш страниц пользователя
+    await db.run_sync(notify, DEADLINES_CHANGED, user.id)
+    await db.commit()
+    user_id = user.id
 
     await state.clear()
+    page_cache.invalidate(user_id)
+    await reminders.refresh_user(user_id)
 
     # Проверяем, активный или просроченный
     now = datetime.utcnow()
@@ -1019,8 +793,18 @@ async def finalize_deadline(message: types.Message, state: FSMContext, link: str
 
 async def main():
     init_db()
+    set_bot_instance(bot)
+    start_scheduler()
     print("🤖 Bot started...")
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            # Telegram не отдает getUpdates, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await dispose()
 
 
 if __name__ == "__main__":
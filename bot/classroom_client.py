@@ -0,0 +1,297 @@
+"""
+Google Classroom client layer shared by the bot and the checker.
+
+Pool of ready-to-use clients:
+- the discovery Resource is built once per user and reused
+- credentials keep the live access token until it expires
+- entries are evicted after SERVICE_POOL_TTL seconds of inactivity
+  or when the pool grows beyond SERVICE_POOL_SIZE users
+
+Quota guard (all processes share one Google Cloud project quota):
+- token bucket stored in Postgres, so the limit holds across processes
+- exponential backoff with full jitter on 429/5xx and network errors
+- circuit breaker: after GOOGLE_API_BREAKER_THRESHOLD consecutive failures
+  all calls are refused with CircuitOpenError for GOOGLE_API_BREAKER_COOLDOWN seconds
+"""
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google.auth.exceptions import TransportError
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from database import get_db, ApiQuotaState
+import httplib2
+import random
+import threading
+import time
+import os
+
+os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
+
+SERVICE_POOL_SIZE = int(os.getenv("SERVICE_POOL_SIZE", "500"))
+SERVICE_POOL_TTL = int(os.getenv("SERVICE_POOL_TTL", "3600"))  # seconds
+
+# Shared Classroom request budget: sustained rate and burst size
+GOOGLE_API_QPS = float(os.getenv("GOOGLE_API_QPS", "10"))
+GOOGLE_API_BURST = int(os.getenv("GOOGLE_API_BURST", "50"))
+MAX_RETRIES = int(os.getenv("GOOGLE_API_MAX_RETRIES", "5"))
+BACKOFF_BASE = 1  # seconds
+BACKOFF_MAX = 60  # seconds
+BREAKER_THRESHOLD = int(os.getenv("GOOGLE_API_BREAKER_THRESHOLD", "20"))
+BREAKER_COOLDOWN = int(os.getenv("GOOGLE_API_BREAKER_COOLDOWN", "300"))  # seconds
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Network failures: timeouts, resets and SSL errors are OSError, DNS failures
+# are httplib2.ServerNotFoundError, a failed token refresh request is TransportError
+TRANSPORT_ERRORS = (OSError, httplib2.HttpLib2Error, TransportError)
+
+SCOPES = [
+    'https://www.googleapis.com/auth/classroom.courses.readonly',
+    'https://www.googleapis.com/auth/classroom.course-work.readonly'
+]
+
+
+def get_credentials(refresh_token: str):
+    return Credentials(
+        None,
+        refresh_token=refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        scopes=SCOPES
+    )
+
+
+def authorized_http(credentials):
+    """New transport for one request: httplib2.Http is not thread-safe"""
+    return AuthorizedHttp(credentials, http=httplib2.Http())
+
+
+class ServicePool:
+    """Bounded LRU of (service, credentials) keyed by user"""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, refresh_token: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            # The token changes when the user reconnects Google
+            if entry and entry['refresh_token'] == refresh_token and now - entry['used_at'] < self.ttl:
+                entry['used_at'] = now
+                self._entries.move_to_end(key)
+                return entry['service'], entry['credentials']
+
+        credentials = get_credentials(refresh_token)
+        service = build('classroom', 'v1', credentials=credentials)
+
+        with self._lock:
+            self._entries[key] = {
+                'refresh_token': refresh_token,
+                'service': service,
+                'credentials': credentials,
+                'used_at': now
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return service, credentials
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+service_pool = ServicePool(SERVICE_POOL_SIZE, SERVICE_POOL_TTL)
+
+
+def get_client(refresh_token: str, key=None):
+    """Return (service, credentials) for the user, building them only on a pool miss"""
+    return service_pool.get(key if key is not None else refresh_token, refresh_token)
+
+
+def invalidate_client(key):
+    """Drop the cached client, e.g. after RefreshError"""
+    service_pool.invalidate(key)
+
+
+class CircuitOpenError(Exception):
+    """Google API calls are paused after repeated failures"""
+
+    def __init__(self, open_until: datetime):
+        super().__init__(f"Google API circuit open until {open_until:%H:%M:%S}")
+        self.open_until = open_until
+
+
+# Refill and take n tokens in one statement; no row is returned if the bucket
+# is short of tokens or the breaker is open. clock_timestamp() keeps every
+# process on the database clock.
+_ACQUIRE_SQL = text("""
+    UPDATE api_quota_state
+    SET tokens = LEAST(:capacity, tokens + EXTRACT(EPOCH FROM clock_timestamp()::timestamp - refilled_at) * :rate) - :n,
+        refilled_at = clock_timestamp()::timestamp
+    WHERE name = :name
+      AND (open_until IS NULL OR open_until < clock_timestamp()::timestamp)
+      AND LEAST(:capacity, tokens + EXTRACT(EPOCH FROM clock_timestamp()::timestamp - refilled_at) * :rate) >= :n
+    RETURNING failures
+""")
+
+_OPEN_UNTIL_SQL = text("""
+    SELECT open_until FROM api_quota_state
+    WHERE name = :name AND open_until >= clock_timestamp()::timestamp
+""")
+
+_FAILURE_SQL = text("""
+    UPDATE api_quota_state
+    SET failures = failures + 1,
+        open_until = CASE WHEN failures + 1 >= :threshold
+                          THEN clock_timestamp()::timestamp + make_interval(secs => :cooldown)
+                          ELSE open_until END
+    WHERE name = :name
+""")
+
+
+class QuotaGuard:
+    """Cross-process token bucket plus circuit breaker for one Google API"""
+
+    def __init__(self, name: str, rate: float, capacity: int):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._ready = False
+
+    def _ensure_row(self, db):
+        if self._ready:
+            return
+        db.execute(
+            insert(ApiQuotaState).values(
+                name=self.name, tokens=self.capacity, refilled_at=datetime.utcnow(), failures=0
+            ).on_conflict_do_nothing(index_elements=[ApiQuotaState.name])
+        )
+        db.commit()
+        self._ready = True
+
+    def acquire(self, n: int = 1) -> int:
+        """
+        Block until n requests may be sent; raises CircuitOpenError during an outage.
+        Returns the current count of consecutive failures.
+        """
+        n = min(n, self.capacity)
+        while True:
+            db = get_db()
+            try:
+                self._ensure_row(db)
+                granted = db.execute(_ACQUIRE_SQL, {
+                    'name': self.name, 'n': n, 'rate': self.rate, 'capacity': self.capacity
+                }).first()
+                db.commit()
+                if granted:
+                    return granted.failures
+                open_until = db.execute(_OPEN_UNTIL_SQL, {'name': self.name}).scalar()
+                if open_until:
+                    raise CircuitOpenError(open_until)
+            finally:
+                db.close()
+            # Tokens come back at `rate` per second
+            time.sleep(n / self.rate * random.uniform(0.5, 1.5))
+
+    def record_success(self):
+        db = get_db()
+        try:
+            db.query(ApiQuotaState).filter(
+                ApiQuotaState.name == self.name
+            ).update({'failures': 0, 'open_until': None}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def record_failure(self):
+        db = get_db()
+        try:
+            db.execute(_FAILURE_SQL, {
+                'name': self.name, 'threshold': BREAKER_THRESHOLD, 'cooldown': BREAKER_COOLDOWN
+            })
+            db.commit()
+        finally:
+            db.close()
+
+
+quota = QuotaGuard('classroom', GOOGLE_API_QPS, GOOGLE_API_BURST)
+
+
+def _is_retryable(error) -> bool:
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+def _backoff(attempt: int):
+    """Exponential backoff with full jitter"""
+    time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+
+def execute(request, credentials):
+    """Execute one API request through the quota guard, retrying 429/5xx and network errors"""
+    for attempt in range(MAX_RETRIES + 1):
+        failures = quota.acquire()
+        try:
+            response = request.execute(http=authorized_http(credentials))
+        except (HttpError, *TRANSPORT_ERRORS) as e:
+            if not _is_retryable(e):
+                raise
+            quota.record_failure()
+            if attempt == MAX_RETRIES:
+                raise
+            _backoff(attempt)
+            continue
+        if failures:
+            quota.record_success()
+        return response
+
+
+def execute_batch(service, credentials, requests, callback):
+    """
+    Execute {request_id: HttpRequest} as one Google batch request through the
+    quota guard. Parts that fail with 429/5xx, and the whole batch on a
+    network error, are retried with backoff;
+    callback(request_id, response, exception) receives the final result of every part.
+    """
+    pending = dict(requests)
+    for attempt in range(MAX_RETRIES + 1):
+        retry = {}
+
+        def on_response(request_id, response, exception):
+            if exception is not None and _is_retryable(exception) and attempt < MAX_RETRIES:
+                retry[request_id] = pending[request_id]
+            else:
+                callback(request_id, response, exception)
+
+        failures = quota.acquire(len(pending))
+        batch = service.new_batch_http_request(callback=on_response)
+        for request_id, request in pending.items():
+            batch.add(request, request_id=request_id)
+
+        try:
+            batch.execute(http=authorized_http(credentials))
+        except (HttpError, *TRANSPORT_ERRORS) as e:
+            # The whole batch was rejected or never got an answer
+            if not _is_retryable(e) or attempt == MAX_RETRIES:
+                raise
+            retry = pending
+
+        if not retry:
+            if failures:
+                quota.record_success()
+            return
+
+        quota.record_failure()
+        pending = retry
+        _backoff(attempt)
@@ -1,211 +1,353 @@
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 from google.auth.exceptions import RefreshError
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import os
-from database import get_db, Deadline, Coursework
+from database import get_db, Coursework, CourseSyncState, upsert_deadlines, upsert_coursework, prune_coursework
+from classroom_client import get_client, invalidate_client, execute, execute_batch, CircuitOpenError
 
-os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
+# Максимум одновременных batch-запросов к Classroom при загрузке заданий курсов
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "8"))
+# Classroom принимает не больше 50 запросов в одном batch
+BATCH_SIZE = 50
+# Максимальный pageSize для courses.list и courseWork.list
+PAGE_SIZE = 100
+# Сколько записей копится перед одной пачкой INSERT ... ON CONFLICT
+WRITE_CHUNK_SIZE = int(os.getenv("SYNC_WRITE_CHUNK_SIZE", "500"))
+# Удаление задания не меняет updateTime курса: раз в этот период курс синхронизируется целиком
+FULL_RESYNC_INTERVAL = timedelta(hours=int(os.getenv("SYNC_FULL_RESYNC_HOURS", "24")))
 
 
-def get_classroom_service(refresh_token: str):
-    credentials = Credentials(
-        None,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.getenv("GOOGLE_CLIENT_ID"),
-        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-        scopes=[
-            'https://www.googleapis.com/auth/classroom.courses.readonly',
-            'https://www.googleapis.com/auth/classroom.course-work.readonly'
-        ]
-    )
-    return build('classroom', 'v1', credentials=credentials)
+def parse_update_time(value):
+    """RFC 3339 updateTime из Classroom -> naive UTC datetime"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value).replace(tzinfo=None)
 
 
-def fetch_all_deadlines(refresh_token: str, telegram_id: int):
+def list_active_courses(service, credentials):
+    courses = []
+    request = service.courses().list(courseStates=['ACTIVE'], pageSize=PAGE_SIZE)
+    while request is not None:
+        courses_response = execute(request, credentials)
+        courses.extend(courses_response.get('courses', []))
+        request = service.courses().list_next(request, courses_response)
+    return courses
+
+
+def _parse_coursework(course, coursework_list, telegram_id: int, watermark=None):
+    """
+    Разбор страницы заданий одного курса на дедлайны и задания без дедлайна.
+
+    Задания приходят по убыванию updateTime, поэтому на первом задании не новее
+    watermark разбор останавливается. Возвращает (deadlines, coursework, reached_watermark).
+    """
+    course_id = course['id']
+    course_name = course['name']
+    deadlines = []
+    coursework_no_deadline = []
+
+    for work in coursework_list:
+        update_time = parse_update_time(work.get('updateTime'))
+        if watermark and update_time and update_time <= watermark:
+            return deadlines, coursework_no_deadline, True
+
+        work_title = work.get('title', 'Без назви')
+        link = work.get('alternateLink', '')
+        # Uniqueness by user: telegram_id_course_id_work_id
+        external_id = f"{telegram_id}_{course_id}_{work['id']}"
+
+        # Проверяем наличие dueDate
+        if 'dueDate' not in work:
+            # Сохраняем как coursework без дедлайна
+            coursework_no_deadline.append({
+                'course_name': course_name,
+                'title': work_title,
+                'link': link,
+                'external_id': external_id,
+                'update_time': update_time
+            })
+            continue
+
+        try:
+            due_date_dict = work.get('dueDate')
+            due_time_dict = work.get('dueTime', {})
+
+            due_date = datetime(
+                due_date_dict['year'],
+                due_date_dict['month'],
+                due_date_dict['day'],
+                due_time_dict.get('hours', 23),
+                due_time_dict.get('minutes', 59)
+            )
+
+            deadlines.append({
+                'course_name': course_name,
+                'title': work['title'],
+                'due_date': due_date,
+                'link': link,
+                'external_id': external_id,
+                'update_time': update_time
+            })
+
+        except KeyError as e:
+            print(f"  ❌ Помилка парсингу дедлайну '{work_title}': відсутнє поле {e}")
+        except Exception as e:
+            print(f"  ❌ Помилка обробки '{work_title}': {e}")
+
+    return deadlines, coursework_no_deadline, False
+
+
+def _fetch_pages_batch(service, credentials, pages, telegram_id: int, watermarks):
+    """
+    Загрузка одной страницы заданий для каждого (course, page_token) из pages
+    одним batch-запросом (выполняется в рабочем потоке).
+    Возвращает [(course, deadlines, coursework, next_page_token)] для успешных курсов.
+    """
+    results = []
+
+    def on_response(request_id, response, exception):
+        course, _ = pages[int(request_id)]
+        if exception is not None:
+            # Ошибка одного курса не влияет на остальные
+            print(f"❌ Ошибка при получении заданий курса {course['name']}: {exception}")
+            return
+        deadlines, coursework_no_deadline, reached_watermark = _parse_coursework(
+            course, response.get('courseWork', []), telegram_id, watermarks.get(course['id'])
+        )
+        next_page_token = None if reached_watermark else response.get('nextPageToken')
+        results.append((course, deadlines, coursework_no_deadline, next_page_token))
+
+    requests = {
+        str(idx): service.courses().courseWork().list(
+            courseId=course['id'],
+            pageSize=PAGE_SIZE,
+            pageToken=page_token,
+            orderBy='updateTime desc'
+        )
+        for idx, (course, page_token) in enumerate(pages)
+    }
+
+    # Ошибка всего batch (сеть, недоступность Google) прерывает синхронизацию
+    execute_batch(service, credentials, requests, on_response)
+    return results
+
+
+def fetch_all_deadlines(refresh_token: str, telegram_id: int, courses=None, watermarks=None,
+                        max_workers: int = None):
+    """
+    Потоковая загрузка заданий по всем активным курсам.
+
+    Генератор проходит все страницы courseWork.list и отдаёт записи
+    ('deadline', course_id, data) и ('coursework', course_id, data), а после
+    последней страницы курса - ('done', course_id, None). Для курса, который
+    не удалось загрузить, 'done' не отдаётся; ошибка всего запроса
+    пробрасывается вызывающему.
+
+    Страницы запрашиваются batch-запросами по BATCH_SIZE курсов, batch-и
+    выполняются параллельно, не более max_workers одновременно
+    (по умолчанию SYNC_CONCURRENCY, 1 - последовательно). В памяти держится
+    не больше одного раунда страниц, независимо от размера курса.
+    Если courses уже получены через list_active_courses, повторно они не запрашиваются.
+    """
+    if max_workers is None:
+        max_workers = SYNC_CONCURRENCY
+    if watermarks is None:
+        watermarks = {}
+
     try:
-        service = get_classroom_service(refresh_token)
-        courses_response = service.courses().list(
-            courseStates=['ACTIVE'],
-            pageSize=100
-        ).execute()
-
-        courses = courses_response.get('courses', [])
-        all_deadlines = []
-        all_coursework_no_deadline = []
-
-        # print(f"🔍 Знайдено курсів: {len(courses)}")
-
-        for course in courses:
-            course_id = course['id']
-            course_name = course['name']
-
-            try:
-                coursework_response = service.courses().courseWork().list(
-                    courseId=course_id,
-                    pageSize=100
-                ).execute()
-
-                coursework_list = coursework_response.get('courseWork', [])
-
-                if len(coursework_list) > 0:
-                    pass
-                    # print(f"📘 Курс '{course_name}': {len(coursework_list)} завдань.")
-
-                for work in coursework_list:
-                    work_title = work.get('title', 'Без назви')
-                    link = work.get('alternateLink', '')
-                    # Uniqueness by user: telegram_id_course_id_work_id
-                    external_id = f"{telegram_id}_{course_id}_{work['id']}"
-                    
-                    # Проверяем наличие dueDate
-                    if 'dueDate' not in work:
-                        # print(f"  ⚠️ Пропущено '{work_title}' - немає dueDate")
-                        
-                        # Сохраняем как coursework без дедлайна
-                        coursework_data = {
-                            'course_name': course_name,
-                            'title': work_title,
-                            'link': link,
-                            'external_id': external_id
-                        }
-                        all_coursework_no_deadline.append(coursework_data)
-                        continue
-
-                    try:
-                        due_date_dict = work.get('dueDate')
-                        due_time_dict = work.get('dueTime', {})
-
-                        due_date = datetime(
-                            due_date_dict['year'],
-                            due_date_dict['month'],
-                            due_date_dict['day'],
-                            due_time_dict.get('hours', 23),
-                            due_time_dict.get('minutes', 59)
-                        )
-
-                        deadline_data = {
-                            'course_name': course_name,
-                            'title': work['title'],
-                            'due_date': due_date,
-                            'link': link,
-                            'external_id': external_id
-                        }
-
-                        all_deadlines.append(deadline_data)
-                        # print(f"  ✅ Додано дедлайн '{work_title}' - {due_date.strftime('%d.%m.%Y %H:%M')}")
-                    
-                    except KeyError as e:
-                        print(f"  ❌ Помилка парсингу дедлайну '{work_title}': відсутнє поле {e}")
-                    except Exception as e:
-                        print(f"  ❌ Помилка обробки '{work_title}': {e}")
-
-            except Exception as e:
-                print(f"❌ Ошибка при получении заданий курса {course_name}: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
+        service, credentials = get_client(refresh_token, telegram_id)
+        if courses is None:
+            # Первый запрос заодно обновляет access token, потоки используют уже готовый
+            courses = list_active_courses(service, credentials)
+
+        def fetch_chunk(chunk):
+            return _fetch_pages_batch(service, credentials, chunk, telegram_id, watermarks)
 
-        # print(f"✅ Всього знайдено {len(all_deadlines)} дедлайнів та {len(all_coursework_no_deadline)} завдань без дедлайнів")
-        return all_deadlines, all_coursework_no_deadline
+        pending = [(course, None) for course in courses]
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            while pending:
+                chunks = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+                if max_workers > 1 and len(chunks) > 1:
+                    chunk_results = executor.map(fetch_chunk, chunks)
+                else:
+                    chunk_results = map(fetch_chunk, chunks)
+
+                pending = []
+                for chunk_result in chunk_results:
+                    for course, deadlines, coursework_no_deadline, next_page_token in chunk_result:
+                        for dl_data in deadlines:
+                            yield 'deadline', course['id'], dl_data
+                        for cw_data in coursework_no_deadline:
+                            yield 'coursework', course['id'], cw_data
+
+                        if next_page_token:
+                            pending.append((course, next_page_token))
+                        else:
+                            yield 'done', course['id'], None
 
     except RefreshError:
         print(f"❌ Token expired or revoked for fetch_all_deadlines")
+        invalidate_client(telegram_id)
+        raise
+    except CircuitOpenError:
         raise
     except Exception as e:
         print(f"❌ Ошибка при получении данных из Classroom: {e}")
         import traceback
         traceback.print_exc()
-        return [], []
+        # Неполные данные - не успешная синхронизация: очередь повторит ее через RETRY_DELAY
+        raise
+
+
+class SyncWriter:
+    """DB stage of the sync pipeline: buffers records and writes them in chunks"""
+
+    def __init__(self, db, user_id: int, chunk_size: int = WRITE_CHUNK_SIZE):
+        self.db = db
+        self.user_id = user_id
+        self.chunk_size = chunk_size
+        # external_id -> (kind, data): an item seen twice in one chunk is written once, as last seen
+        self.records = {}
+        self.added_count = 0
+        self.updated_count = 0
+
+    def add(self, kind: str, data):
+        self.records[data['external_id']] = (kind, data)
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        deadlines = [data for kind, data in self.records.values() if kind == 'deadline']
+        coursework = [data for kind, data in self.records.values() if kind != 'deadline']
+
+        added, updated = upsert_deadlines(self.db, self.user_id, deadlines)
+        self.added_count += added
+        self.updated_count += updated
+
+        # Задания, получившие dueDate, переезжают в дедлайны
+        deadline_ids = [dl['external_id'] for dl in deadlines]
+        if deadline_ids:
+            self.db.query(Coursework).filter(
+                Coursework.external_id.in_(deadline_ids)
+            ).delete(synchronize_session=False)
+
+        upsert_coursework(self.db, self.user_id, coursework)
+
+        self.records = {}
 
 
 def sync_user_deadlines(user_id: int, telegram_id: int, google_token: str):
-    """Синхронизация дедлайнов пользователя"""
+    """
+    Инкрементальная синхронизация дедлайнов пользователя.
+
+    Для каждого курса хранится watermark (CourseSyncState): updateTime курса
+    и последний увиденный updateTime задания. Если курс не менялся, в базу
+    записываются только задания, изменившиеся после watermark; при изменении
+    курса (например, переименовании) он синхронизируется целиком. Удаленные
+    в Classroom задания видны только при полной синхронизации, поэтому она
+    выполняется и раз в FULL_RESYNC_INTERVAL.
+    Записи из fetch_all_deadlines пишутся в базу пачками по WRITE_CHUNK_SIZE.
+    """
     print(f"🔄 Синхронизация для user {telegram_id}...")
 
-    deadlines_data, coursework_no_deadline_data = fetch_all_deadlines(google_token, telegram_id)
-    
     # Получаем все курсы из Google Classroom
     try:
-        from googleapiclient.discovery import build
-        from google.oauth2.credentials import Credentials
-        
-        credentials = Credentials(
-            None,
-            refresh_token=google_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=os.getenv("GOOGLE_CLIENT_ID"),
-            client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-            scopes=[
-                'https://www.googleapis.com/auth/classroom.courses.readonly',
-                'https://www.googleapis.com/auth/classroom.course-work.readonly'
-            ]
-        )
-        service = build('classroom', 'v1', credentials=credentials)
-        courses_response = service.courses().list(
-            courseStates=['ACTIVE'],
-            pageSize=100
-        ).execute()
-        all_courses = [course['name'] for course in courses_response.get('courses', [])]
+        service, credentials = get_client(google_token, telegram_id)
+        courses = list_active_courses(service, credentials)
     except RefreshError:
         print(f"❌ Token expired or revoked for courses list")
+        invalidate_client(telegram_id)
+        raise
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"❌ Ошибка при получении курсов из Classroom: {e}")
         raise
-    except:
-        all_courses = []
 
-    if not deadlines_data and not coursework_no_deadline_data:
-        print(f"⚠️ Нет дедлайнов для user {telegram_id}")
-        return 0, 0, all_courses
+    all_courses = [course['name'] for course in courses]
 
     db = get_db()
-    added_count = 0
-    updated_count = 0
-    coursework_added = 0
-
-    # Сохраняем дедлайны
-    for dl_data in deadlines_data:
-        existing = db.query(Deadline).filter(
-            Deadline.external_id == dl_data['external_id']
-        ).first()
-
-        if existing:
-            existing.due_date = dl_data['due_date']
-            existing.title = dl_data['title']
-            existing.link = dl_data['link']
-            existing.notified = False
-            updated_count += 1
-        else:
-            new_deadline = Deadline(
-                user_id=user_id,
-                course_name=dl_data['course_name'],
-                title=dl_data['title'],
-                due_date=dl_data['due_date'],
-                link=dl_data['link'],
-                external_id=dl_data['external_id'],
-                notified=False
-            )
-            db.add(new_deadline)
-            added_count += 1
-
-    # Удаляем старые coursework без дедлайнов для этого пользователя
-    db.query(Coursework).filter(Coursework.user_id == user_id).delete()
-
-    # Сохраняем coursework без дедлайнов
-    for cw_data in coursework_no_deadline_data:
-        new_coursework = Coursework(
-            user_id=user_id,
-            course_name=cw_data['course_name'],
-            title=cw_data['title'],
-            link=cw_data['link'],
-            external_id=cw_data['external_id']
-        )
-        db.add(new_coursework)
-        coursework_added += 1
+    try:
+        states = {
+            state.course_id: state
+            for state in db.query(CourseSyncState).filter(CourseSyncState.user_id == user_id)
+        }
+
+        course_update_times = {
+            course['id']: parse_update_time(course.get('updateTime')) for course in courses
+        }
+        now = datetime.utcnow()
+        watermarks = {}
+        for course_id, course_update_time in course_update_times.items():
+            state = states.get(course_id)
+            if (state and state.coursework_update_time and state.course_update_time == course_update_time
+                    and state.full_synced_at and now - state.full_synced_at < FULL_RESYNC_INTERVAL):
+                watermarks[course_id] = state.coursework_update_time
+
+        writer = SyncWriter(db, user_id)
+        changed = set()  # Курсы, в которых были изменения
+        latest_update = {}  # course_id -> максимальный updateTime среди загруженных заданий
+        seen_coursework = {}  # course_id -> external_id заданий без дедлайна (для полной синхронизации)
+
+        for kind, course_id, data in fetch_all_deadlines(
+            google_token, telegram_id, courses=courses, watermarks=watermarks
+        ):
+            if kind == 'done':
+                full_resync = course_id not in watermarks
+                if not full_resync and course_id not in changed:
+                    continue  # Курс не изменился
+
+                if full_resync:
+                    # Задания без дедлайна, которых больше нет в курсе
+                    prune_coursework(
+                        db, user_id, seen_coursework.pop(course_id, set()),
+                        Coursework.external_id.startswith(f"{telegram_id}_{course_id}_", autoescape=True)
+                    )
+
+                update_times = [latest_update.get(course_id), watermarks.get(course_id)]
+                state = states.get(course_id)
+                if not state:
+                    state = CourseSyncState(user_id=user_id, course_id=course_id)
+                    db.add(state)
+                state.course_update_time = course_update_times[course_id]
+                if full_resync:
+                    state.full_synced_at = now
+                state.coursework_update_time = max(
+                    [t for t in update_times if t], default=datetime(1970, 1, 1)
+                )
+                continue
+
+            changed.add(course_id)
+            if data['update_time'] and (course_id not in latest_update
+                                        or data['update_time'] > latest_update[course_id]):
+                latest_update[course_id] = data['update_time']
+            if kind == 'coursework' and course_id not in watermarks:
+                seen_coursework.setdefault(course_id, set()).add(data['external_id'])
+
+            writer.add(kind, data)
+
+        writer.flush()
+        added_count = writer.added_count
+        updated_count = writer.updated_count
+
+        # Курсы, которые больше не активны: их задания без дедлайна и watermark удаляем
+        active_ids = {course['id'] for course in courses}
+        stale_ids = [course_id for course_id in states if course_id not in active_ids]
+        if stale_ids:
+            db.query(CourseSyncState).filter(
+                CourseSyncState.user_id == user_id,
+                CourseSyncState.course_id.in_(stale_ids)
+            ).delete(synchronize_session=False)
+        db.query(Coursework).filter(
+            Coursework.user_id == user_id,
+            Coursework.course_name.notin_(all_courses)
+        ).delete(synchronize_session=False)
+
+        db.commit()
+    finally:
+        db.close()
 
-    db.commit()
-    db.close()
+    if not added_count and not updated_count:
+        print(f"⚠️ Нет изменений для user {telegram_id}")
 
-    # print(f"✅ User {telegram_id}: додано {added_count}, оновлено {updated_count}, завдань без дедлайнів: {coursework_added}")
-    
     return added_count, updated_count, all_courses
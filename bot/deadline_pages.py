@@ -0,0 +1,183 @@
+"""
+Paged deadline lists behind the bot's deadline views:
+- a page is one LIMIT/OFFSET query in (due_date, id) order over
+  ix_deadlines_user_due, the user's full history is never loaded
+- the page count comes from one aggregate over the same index
+- pages are cached per user, pre-rendered except for the "time left" lines;
+  an entry is dropped when the user's deadlines change (sync, new deadline,
+  NOTIFY from another process) or when its earliest active deadline passes
+  and the views shift
+- queries run on the handler's AsyncSession (see async_db)
+- deadline_page() returns the page text and navigation keyboard for every
+  handler showing active or overdue deadlines
+"""
+import os
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select, func
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from database import Deadline
+
+DEADLINES_PER_PAGE = 5
+# Users whose pages are kept, least recently viewed are evicted first
+PAGE_CACHE_USERS = int(os.getenv("PAGE_CACHE_USERS", "1000"))
+PAGES_PER_USER = 20
+
+ACTIVE = 'active'
+OVERDUE = 'overdue'
+
+# View: page title, text when empty, callback data prefix of its pages
+VIEWS = {
+    ACTIVE: ("📚 <b>Активні дедлайни", "📭 У вас немає активних дедлайнів.", "dl_page_"),
+    OVERDUE: ("❌ <b>Прострочені дедлайни", "✅ У вас немає прострочених дедлайнів!", "overdue_page_"),
+}
+
+
+class PageCache:
+    """Bounded LRU of users' rendered pages; used from the event loop only"""
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> {'expires_at', 'pages'}
+        # Bumped by every invalidation, a page loaded before it is not stored
+        self.version = 0
+
+    def get(self, user_id: int, view: str, page: int, now: datetime):
+        entry = self._users.get(user_id)
+        if entry is None or now >= entry['expires_at']:
+            return None
+        self._users.move_to_end(user_id)
+        return entry['pages'].get((view, page))
+
+    def put(self, user_id: int, view: str, page: int, loaded, version: int):
+        if version != self.version:
+            return
+        entry = self._users.get(user_id)
+        if entry is None or entry['expires_at'] != loaded['expires_at']:
+            entry = {'expires_at': loaded['expires_at'], 'pages': {}}
+            self._users[user_id] = entry
+        self._users.move_to_end(user_id)
+        entry['pages'][(view, page)] = loaded
+        if len(entry['pages']) > PAGES_PER_USER:
+            entry['pages'].pop(next(iter(entry['pages'])))
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self.version += 1
+        self._users.pop(user_id, None)
+
+    def clear(self):
+        self.version += 1
+        self._users.clear()
+
+
+page_cache = PageCache(PAGE_CACHE_USERS)
+
+
+def _filter(view: str, user_id: int, now: datetime):
+    if view == ACTIVE:
+        return Deadline.user_id == user_id, Deadline.due_date >= now
+    return Deadline.user_id == user_id, Deadline.due_date < now
+
+
+def _order(view: str):
+    if view == ACTIVE:
+        return Deadline.due_date, Deadline.id
+    return Deadline.due_date.desc(), Deadline.id.desc()
+
+
+def _static_parts(view: str, title: str, course_name: str, due_date: datetime, link: str):
+    """Text of one deadline around its "time left" line, which depends on now"""
+    if view == ACTIVE:
+        head = f"✅ <b>{title}</b>\n📖 {course_name}\n⏰ {due_date.strftime('%d.%m.%Y %H:%M')}\n"
+    else:
+        head = f"📝 {title}\n📖 {course_name}\n⏰ Був: {due_date.strftime('%d.%m.%Y %H:%M')}\n"
+    tail = f"🔗 <a href='{link}'>Відкрити</a>\n\n" if link else "\n"
+    return due_date, head, tail
+
+
+def _keyboard(view: str, page: int, total_pages: int):
+    prefix = VIEWS[view][2]
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}{page - 1}"))
+
+    nav_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="ignore"))
+
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"{prefix}{page + 1}"))
+
+    return InlineKeyboardMarkup(inline_keyboard=[nav_buttons])
+
+
+async def load_page(db, user_id: int, view: str, page: int, now: datetime):
+    """Read one page from the database and pre-render it; the page is clamped to the existing pages"""
+    # Both counts and the moment the views shift, in one pass over the index
+    active, overdue, next_due = (await db.execute(
+        select(
+            func.count().filter(Deadline.due_date >= now),
+            func.count().filter(Deadline.due_date < now),
+            func.min(Deadline.due_date).filter(Deadline.due_date >= now)
+        ).where(Deadline.user_id == user_id)
+    )).one()
+    loaded = {'expires_at': next_due or datetime.max, 'parts': None}
+
+    total = active if view == ACTIVE else overdue
+    if not total:
+        return loaded
+    total_pages = (total - 1) // DEADLINES_PER_PAGE + 1
+    page = max(0, min(page, total_pages - 1))
+    rows = (await db.execute(
+        select(Deadline.title, Deadline.course_name, Deadline.due_date, Deadline.link).where(
+            *_filter(view, user_id, now)
+        ).order_by(
+            *_order(view)
+        ).offset(page * DEADLINES_PER_PAGE).limit(DEADLINES_PER_PAGE)
+    )).all()
+
+    loaded['parts'] = [_static_parts(view, *row) for row in rows]
+    loaded['title'] = f"{VIEWS[view][0]} ({page + 1}/{total_pages}):</b>\n\n"
+    loaded['reply_markup'] = _keyboard(view, page, total_pages)
+    return loaded
+
+
+def _time_line(view: str, due_date: datetime, now: datetime) -> str:
+    if view == ACTIVE:
+        time_left = due_date - now
+        days_left = time_left.days
+        hours_left = time_left.seconds // 3600
+        if days_left > 0:
+            return f"⏳ Залишилось: {days_left} д. {hours_left} год.\n"
+        return f"⏳ Залишилось: {hours_left} год.\n"
+
+    time_ago = now - due_date
+    days_ago = time_ago.days
+    hours_ago = time_ago.seconds // 3600
+    if days_ago > 0:
+        return f"⌛ Прострочено: {days_ago} д. {hours_ago} год. тому\n"
+    return f"⌛ Прострочено: {hours_ago} год. тому\n"
+
+
+async def deadline_page(db, user, view: str, page: int = 0):
+    """
+    (text, reply_markup) of one page of the user's active or overdue deadlines;
+    user is the handler's UserIdentity, reply_markup is None when there is
+    nothing to page through
+    """
+    if user is None:
+        return "❌ Користувача не знайдено. Спробуйте /start", None
+
+    now = datetime.utcnow()
+    loaded = page_cache.get(user.id, view, page, now)
+    if loaded is None:
+        version = page_cache.version
+        loaded = await load_page(db, user.id, view, page, now)
+        page_cache.put(user.id, view, page, loaded, version)
+
+    if not loaded['parts']:
+        return VIEWS[view][1], None
+    text = loaded['title'] + "".join(
+        head + _time_line(view, due_date, now) + tail for due_date, head, tail in loaded['parts']
+    )
+    return text, loaded['reply_markup']
@@ -0,0 +1,91 @@
+"""
+Telegram id -> user identity for the bot handlers:
+- IdentityMiddleware resolves the sender of every update once and passes
+  it to handlers as `user` (a UserIdentity, or None before /start)
+- identities are kept in a bounded LRU, so button presses don't query
+  the users table
+- an entry is dropped when the user's Google token changes: locally after
+  RefreshError in /sync, and through the user_changed NOTIFY sent by the
+  OAuth server and other bot replicas
+"""
+import os
+from collections import OrderedDict
+from typing import NamedTuple
+from aiogram import BaseMiddleware
+from sqlalchemy import select
+from database import User
+
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+
+
+class UserIdentity(NamedTuple):
+    id: int
+    telegram_id: int
+    has_token: bool
+
+
+class IdentityCache:
+    """Bounded LRU of telegram_id -> UserIdentity, with a user id index for invalidation"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._telegram_ids = {}  # user id -> telegram_id
+        # Bumped by every invalidation, an identity read before it is not stored
+        self.version = 0
+
+    def get(self, telegram_id: int):
+        identity = self._entries.get(telegram_id)
+        if identity is not None:
+            self._entries.move_to_end(telegram_id)
+        return identity
+
+    def put(self, identity: UserIdentity, version: int):
+        if version != self.version:
+            return
+        self._entries[identity.telegram_id] = identity
+        self._entries.move_to_end(identity.telegram_id)
+        self._telegram_ids[identity.id] = identity.telegram_id
+        while len(self._entries) > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._telegram_ids.pop(evicted.id, None)
+
+    def invalidate(self, user_id: int):
+        self.version += 1
+        telegram_id = self._telegram_ids.pop(user_id, None)
+        if telegram_id is not None:
+            self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self._telegram_ids.clear()
+
+
+identity_cache = IdentityCache(IDENTITY_CACHE_SIZE)
+
+
+async def load_identity(db, telegram_id: int):
+    """Read the identity from the database and cache it; None for an unknown user"""
+    version = identity_cache.version
+    row = (await db.execute(
+        select(User.id, User.google_token.isnot(None)).where(User.telegram_id == telegram_id)
+    )).first()
+    if row is None:
+        return None
+    identity = UserIdentity(row[0], telegram_id, row[1])
+    identity_cache.put(identity, version)
+    return identity
+
+
+class IdentityMiddleware(BaseMiddleware):
+    """Passes the sender's UserIdentity to handlers as `user`; needs DbSessionMiddleware before it"""
+
+    async def __call__(self, handler, event, data):
+        from_user = data.get('event_from_user')
+        if from_user is not None:
+            identity = identity_cache.get(from_user.id)
+            if identity is None:
+                identity = await load_identity(data['db'], from_user.id)
+            data['user'] = identity
+        return await handler(event, data)
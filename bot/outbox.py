@@ -0,0 +1,250 @@
+"""
+Notification outbox shared by the bot and the checker:
+- evaluation marks deadline flags and inserts the notifications in one
+  statement, so a flag is never set without its message being stored
+- the idempotency key (kind, deadline, due date) makes a repeated
+  evaluation a no-op
+- delivery workers lease every pending row of a batch of chats with
+  SELECT ... FOR UPDATE SKIP LOCKED, so one chat's notifications can be
+  merged into a digest and any number of workers can run
+- a row is marked delivered only after Telegram accepted the message it
+  went into; only the rows of failed messages are retried with backoff
+- the lease is renewed while the batch waits in the rate-limited send
+  queue, and a crashed worker's lease simply expires (at-least-once delivery)
+- delivered and given-up rows are deleted after OUTBOX_RETENTION_DAYS
+"""
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, and_, or_, func, literal, cast, String
+from sqlalchemy.dialects.postgresql import insert
+from database import get_db, NotificationOutbox
+from telegram_sender import sender
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Chats whose notifications one worker claims at a time
+BATCH_CHATS = int(os.getenv("OUTBOX_BATCH_CHATS", "100"))
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = 60
+# Delivery loop also wakes up this often to pick up retries and rows of crashed workers
+POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "60"))
+# Delivered and given-up rows are kept this long, then purged by the delivery loop
+RETENTION = timedelta(days=int(os.getenv("OUTBOX_RETENTION_DAYS", "7")))
+PURGE_INTERVAL = timedelta(hours=1)
+
+_COLUMNS = ['telegram_id', 'deadline_id', 'course_name', 'title', 'due_date', 'link']
+
+wakeup = asyncio.Event()
+
+
+def enqueue_marked(db, kind: str, marked) -> int:
+    """
+    Insert one notification per row returned by `marked`, an UPDATE ... RETURNING
+    telegram_id, deadline_id, course_name, title, due_date, link that sets the
+    `kind` flag. Runs as a single statement; the caller commits. Returns rows queued.
+    """
+    marked = marked.cte('marked')
+    now = datetime.utcnow()
+    key = (
+        literal(f"{kind}:") + cast(marked.c.deadline_id, String)
+        + literal(":") + func.to_char(marked.c.due_date, 'YYYYMMDDHH24MI')
+    )
+    stmt = insert(NotificationOutbox).from_select(
+        _COLUMNS + ['kind', 'idempotency_key', 'created_at', 'available_at', 'attempts', 'failed'],
+        select(
+            *(marked.c[column] for column in _COLUMNS),
+            literal(kind), key, literal(now), literal(now), literal(0), literal(False)
+        )
+    ).on_conflict_do_nothing(index_elements=[NotificationOutbox.idempotency_key])
+    return db.execute(stmt).rowcount
+
+
+def wake_delivery():
+    """Wake the delivery loop of this process"""
+    wakeup.set()
+
+
+def claim(kinds):
+    """Lease all pending notifications of up to BATCH_CHATS chats, returns them as dicts"""
+    now = datetime.utcnow()
+    pending = and_(
+        NotificationOutbox.kind.in_(kinds),
+        NotificationOutbox.delivered_at == None,
+        NotificationOutbox.failed == False,
+        NotificationOutbox.available_at <= now,
+        or_(NotificationOutbox.lease_expires_at == None, NotificationOutbox.lease_expires_at < now)
+    )
+    chats = select(NotificationOutbox.telegram_id).where(pending).group_by(
+        NotificationOutbox.telegram_id
+    ).order_by(
+        func.min(NotificationOutbox.available_at)
+    ).limit(BATCH_CHATS)
+    ids = select(NotificationOutbox.id).where(
+        pending, NotificationOutbox.telegram_id.in_(chats.scalar_subquery())
+    ).with_for_update(skip_locked=True)
+
+    db = get_db()
+    try:
+        rows = db.execute(
+            update(NotificationOutbox).where(
+                NotificationOutbox.id.in_(ids.scalar_subquery())
+            ).values(
+                lease_owner=WORKER_ID,
+                lease_expires_at=now + timedelta(seconds=LEASE_SECONDS)
+            ).returning(
+                NotificationOutbox.id, NotificationOutbox.kind,
+                *(getattr(NotificationOutbox, column) for column in _COLUMNS)
+            )
+        ).all()
+        db.commit()
+        return [dict(row._mapping) for row in rows]
+    finally:
+        db.close()
+
+
+def renew(ids) -> int:
+    """Extend our lease on notifications, returns how many we still hold"""
+    db = get_db()
+    try:
+        renewed = db.execute(
+            update(NotificationOutbox).where(
+                NotificationOutbox.id.in_(ids),
+                NotificationOutbox.lease_owner == WORKER_ID
+            ).values(lease_expires_at=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+        ).rowcount
+        db.commit()
+        return renewed
+    finally:
+        db.close()
+
+
+def complete(ids):
+    """Mark notifications delivered"""
+    if not ids:
+        return
+    db = get_db()
+    try:
+        db.execute(
+            update(NotificationOutbox).where(
+                NotificationOutbox.id.in_(ids),
+                NotificationOutbox.lease_owner == WORKER_ID
+            ).values(delivered_at=datetime.utcnow(), lease_owner=None, lease_expires_at=None)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def retry(ids):
+    """Put notifications back with exponential backoff, giving up after MAX_ATTEMPTS"""
+    if not ids:
+        return
+    db = get_db()
+    try:
+        db.execute(
+            update(NotificationOutbox).where(
+                NotificationOutbox.id.in_(ids),
+                NotificationOutbox.lease_owner == WORKER_ID
+            ).values(
+                attempts=NotificationOutbox.attempts + 1,
+                available_at=literal(datetime.utcnow()) + func.make_interval(
+                    0, 0, 0, 0, 0, 0, RETRY_BASE_SECONDS * func.power(2, NotificationOutbox.attempts)
+                ),
+                failed=NotificationOutbox.attempts + 1 >= MAX_ATTEMPTS,
+                lease_owner=None,
+                lease_expires_at=None
+            )
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def purge() -> int:
+    """Delete notifications delivered or given up on more than RETENTION ago"""
+    db = get_db()
+    try:
+        purged = db.execute(
+            delete(NotificationOutbox).where(
+                NotificationOutbox.created_at < datetime.utcnow() - RETENTION,
+                or_(NotificationOutbox.delivered_at != None, NotificationOutbox.failed == True)
+            )
+        ).rowcount
+        db.commit()
+        return purged
+    finally:
+        db.close()
+
+
+async def _keep_lease(ids):
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        renewed = await asyncio.to_thread(renew, ids)
+        if renewed < len(ids):
+            print(f"  ⚠️ Lost outbox lease on {len(ids) - renewed} notifications")
+            return
+
+
+async def deliver(kinds, render) -> int:
+    """
+    Send every pending notification of `kinds`. render(items) turns the
+    notifications of one chat into [(message text, items in it)].
+    Returns the number delivered.
+    """
+    delivered = 0
+    while True:
+        items = await asyncio.to_thread(claim, kinds)
+        if not items:
+            return delivered
+
+        # A batch can take longer than LEASE_SECONDS to get through the send queue
+        keeper = asyncio.create_task(_keep_lease([item['id'] for item in items]))
+        try:
+            by_chat = {}
+            for item in items:
+                by_chat.setdefault(item['telegram_id'], []).append(item)
+            sends = [
+                (message_items, sender.send(telegram_id, text, parse_mode="HTML"))
+                for telegram_id, chat_items in by_chat.items()
+                for text, message_items in render(chat_items)
+            ]
+
+            done, failed = [], []
+            for message_items, future in sends:
+                ok = await future
+                (done if ok else failed).extend(item['id'] for item in message_items)
+        finally:
+            keeper.cancel()
+        await asyncio.to_thread(complete, done)
+        await asyncio.to_thread(retry, failed)
+        delivered += len(done)
+
+
+async def run_delivery(kinds, render):
+    """
+    Deliver notifications of `kinds` whenever wake_delivery() is called, and
+    every POLL_SECONDS; purge old rows every PURGE_INTERVAL
+    """
+    next_purge = datetime.utcnow()
+    while True:
+        wakeup.clear()
+        try:
+            delivered = await deliver(kinds, render)
+            if delivered:
+                print(f"📨 Delivered {delivered} notifications, {sender.qsize()} messages still queued")
+        except Exception as e:
+            print(f"❌ Outbox delivery failed: {e}")
+        if datetime.utcnow() >= next_purge:
+            next_purge = datetime.utcnow() + PURGE_INTERVAL
+            try:
+                purged = await asyncio.to_thread(purge)
+                if purged:
+                    print(f"🧹 Purged {purged} old notifications")
+            except Exception as e:
+                print(f"❌ Outbox purge failed: {e}")
+        try:
+            await asyncio.wait_for(wakeup.wait(), POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
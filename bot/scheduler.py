@@ -1,21 +1,34 @@
 """
 Background scheduler for automated tasks:
-- Auto-synchronization every 6-12 hours
-- Reminder notifications before deadlines
+- Auto-synchronization, each user on an adaptive interval (see sync_queue)
+- Reminder notifications before deadlines, fired at exact times from an in-memory heap
+- Postgres NOTIFY events re-evaluate a user's reminders or sync within seconds
 """
 import asyncio
+import heapq
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime, timedelta
-from database import get_db, User, Deadline, UserSettings
+from sqlalchemy import select, update, tuple_
+from database import get_db, User, Deadline, REMINDER_GRACE, REMINDER_BITS, refresh_next_reminders, DEADLINES_CHANGED, SYNC_REQUESTED, USER_CHANGED
 from classroom_sync import sync_user_deadlines
+from sync_queue import process_due_users
+from telegram_sender import sender, pack_messages, html_field
+from outbox import enqueue_marked, wake_delivery, run_delivery
+from db_events import listen
+from deadline_pages import page_cache
+from identity import identity_cache
+from state_store import state_store
 import os
 
 
 # Bot instance will be set from bot.py
 bot_instance = None
 
+# How often this replica looks for due users in the sync queue
+SYNC_POLL_MINUTES = int(os.getenv("SYNC_POLL_MINUTES", "5"))
+
 
 def set_bot_instance(bot):
     """Set bot instance for sending notifications"""
@@ -23,165 +36,305 @@ def set_bot_instance(bot):
     bot_instance = bot
 
 
+async def _auto_sync_user(user_id: int, telegram_id: int, google_token: str):
+    print(f"  Syncing user {telegram_id}...")
+    added, updated, courses = await asyncio.to_thread(
+        sync_user_deadlines,
+        user_id,
+        telegram_id,
+        google_token
+    )
+
+    if added > 0 or updated > 0:
+        page_cache.invalidate(user_id)
+        await reminders.refresh_user(user_id)
+
+    if bot_instance and (added > 0 or updated > 0):
+        sender.send(
+            telegram_id,
+            f"🔄 Автоматична синхронізація завершена!\n"
+            f"📝 Додано: {added}\n"
+            f"🔄 Оновлено: {updated}"
+        )
+
+    return added + updated
+
+
 async def auto_sync_all_users():
-    """Auto-sync all users with enabled auto-sync"""
+    """Sync users that are due, claiming them from the shared sync queue"""
     print(f"🔄 Auto-sync task started at {datetime.now()}")
-    
-    db = get_db()
-    
-    # Get all users with auto-sync enabled
-    users = db.query(User).join(
-        UserSettings, User.id == UserSettings.user_id, isouter=True
-    ).filter(
-        (UserSettings.auto_sync_enabled == True) | (UserSettings.id == None)
-    ).all()
-    
-    for user in users:
-        if not user.google_token:
-            continue
-            
+
+    synced = await process_due_users(_auto_sync_user)
+
+    print(f"✅ Auto-sync completed ({synced} users)")
+
+
+# Reminder texts by kind (offsets are in database.REMINDER_OFFSETS): header, digest label
+REMINDERS = {
+    'reminder_7days': ("📅 <b>Нагадування за 7 днів!</b>", "📅 <b>За 7 днів</b>"),
+    'reminder_3days': ("📅 <b>Нагадування за 3 дні!</b>", "📅 <b>За 3 дні</b>"),
+    'reminder_2days': ("📅 <b>Нагадування за 2 дні!</b>", "📅 <b>За 2 дні</b>"),
+    'reminder_1day': ("📅 <b>Нагадування за 1 день!</b>", "📅 <b>За 1 день</b>"),
+    'reminder_12hours': ("⏰ <b>Нагадування за 12 годин!</b>", "⏰ <b>За 12 годин</b>"),
+    'reminder_6hours': ("⏰ <b>Нагадування за 6 годин!</b>", "⏰ <b>За 6 годин</b>"),
+    'reminder_3hours': ("⏰ <b>Нагадування за 3 години!</b>", "⏰ <b>За 3 години</b>"),
+    'reminder_2hours': ("⏰ <b>Нагадування за 2 години!</b>", "⏰ <b>За 2 години</b>"),
+    'reminder_1hour': ("🚨 <b>НАГАДУВАННЯ ЗА 1 ГОДИНУ!</b>", "🚨 <b>ЗА 1 ГОДИНУ</b>"),
+    'reminder_30min': ("🚨 <b>НАГАДУВАННЯ ЗА 30 ХВИЛИН!</b>", "🚨 <b>ЗА 30 ХВИЛИН</b>"),
+    'reminder_15min': ("🚨 <b>НАГАДУВАННЯ ЗА 15 ХВИЛИН!</b>", "🚨 <b>ЗА 15 ХВИЛИН</b>"),
+}
+# Full reload from the database; also picks up deadlines written by the checker
+REMINDER_RELOAD_MINUTES = int(os.getenv("REMINDER_RELOAD_MINUTES", "10"))
+# Only reminders firing within this horizon are kept in memory
+REMINDER_HORIZON = timedelta(minutes=2 * REMINDER_RELOAD_MINUTES)
+# Rows fetched per round trip when streaming reminders from the database
+REMINDER_FETCH_SIZE = 1000
+# Expired and excess bot state (state_store) is removed this often
+STATE_PURGE_MINUTES = 10
+# Reminders firing this soon are queued together with the due ones, so they share a digest
+REMINDER_COALESCE = timedelta(seconds=int(os.getenv("REMINDER_COALESCE_SECONDS", "60")))
+
+
+def _reminder_messages(reminders):
+    """
+    One message for a single reminder, otherwise a digest split at Telegram's
+    length limit; returns [(text, reminders in it)]
+    """
+    if len(reminders) == 1:
+        return [(_reminder_message(reminders[0]), reminders)]
+
+    blocks = []
+    for deadline in sorted(reminders, key=lambda r: r['due_date']):
+        block = (
+            f"{REMINDERS[deadline['kind']][1]}\n"
+            f"📖 {html_field(deadline['course_name'])}\n"
+            f"📝 {html_field(deadline['title'])}\n"
+            f"⏰ {deadline['due_date'].strftime('%d.%m.%Y %H:%M')}\n"
+        )
+        if deadline['link']:
+            block += f"🔗 <a href='{deadline['link']}'>Відкрити в Classroom</a>\n"
+        blocks.append((deadline, block + "\n"))
+    return pack_messages(f"🔔 <b>Нагадування про дедлайни ({len(reminders)})</b>\n\n", blocks)
+
+
+def _reminder_message(deadline) -> str:
+    header = REMINDERS[deadline['kind']][0]
+    message = (
+        f"{header}\n\n"
+        f"📖 {html_field(deadline['course_name'])}\n"
+        f"📝 {html_field(deadline['title'])}\n"
+        f"⏰ {deadline['due_date'].strftime('%d.%m.%Y %H:%M')}\n\n"
+    )
+    if deadline['link']:
+        message += f"🔗 <a href='{deadline['link']}'>Відкрити в Classroom</a>"
+    return message
+
+
+class ReminderEngine:
+    """
+    Min-heap of exact reminder fire times:
+    - loads reminders due within REMINDER_HORIZON from the database, an index
+      range scan over Deadline.next_reminder_at (see refresh_next_reminders)
+    - sleeps until the earliest one, re-checks it against the database and
+      queues it in the notification outbox; the outbox delivery loop merges
+      a user's pending reminders into one digest
+    - refresh_user() picks up new or changed deadlines without waiting for a reload
+    Stale heap entries (deadline moved, completed or already reminded) are
+    dropped when they come up.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._queued = set()
+        self._wakeup = asyncio.Event()
+
+    def _load(self, user_id: int = None):
+        query = select(
+            Deadline.next_reminder_at, Deadline.id, Deadline.next_reminder_kind
+        ).where(
+            Deadline.next_reminder_at <= datetime.utcnow() + REMINDER_HORIZON
+        )
+        if user_id is not None:
+            query = query.where(Deadline.user_id == user_id)
+
+        db = get_db()
         try:
-            print(f"  Syncing user {user.telegram_id}...")
-            added, updated, courses = sync_user_deadlines(
-                user.id, 
-                user.telegram_id, 
-                user.google_token
-            )
-            
-            if bot_instance and (added > 0 or updated > 0):
-                await bot_instance.send_message(
-                    user.telegram_id,
-                    f"🔄 Автоматична синхронізація завершена!\n"
-                    f"📝 Додано: {added}\n"
-                    f"🔄 Оновлено: {updated}"
+            result = db.execute(query.execution_options(yield_per=REMINDER_FETCH_SIZE))
+            return [tuple(row) for row in result]
+        finally:
+            db.close()
+
+    def _push(self, entries):
+        earliest = self._heap[0][0] if self._heap else None
+        for entry in entries:
+            if entry not in self._queued:
+                self._queued.add(entry)
+                heapq.heappush(self._heap, entry)
+        if self._heap and (earliest is None or self._heap[0][0] < earliest):
+            self._wakeup.set()
+
+    async def reload(self):
+        """Load every reminder within the horizon"""
+        self._push(await asyncio.to_thread(self._load))
+
+    async def refresh_user(self, user_id: int):
+        """Pick up new or changed deadlines of one user"""
+        self._push(await asyncio.to_thread(self._load, user_id))
+
+    def _claim(self, entries):
+        """
+        Mark due entries sent if they are still the deadline's next reminder and
+        queue their notifications in the outbox (one statement per kind, safe
+        across replicas), then move the deadlines on to their following reminder.
+        Returns (queued, entries of the following reminders within the horizon).
+        """
+        now = datetime.utcnow()
+        by_kind = {}
+        for fire_at, deadline_id, kind in entries:
+            by_kind.setdefault(kind, []).append((deadline_id, fire_at))
+
+        db = get_db()
+        try:
+            queued = 0
+            for kind, keys in by_kind.items():
+                queued += enqueue_marked(db, kind, update(Deadline.__table__).where(
+                    User.id == Deadline.user_id,
+                    # A moved or already reminded deadline no longer matches
+                    tuple_(Deadline.id, Deadline.next_reminder_at).in_(keys),
+                    Deadline.next_reminder_kind == kind,
+                    Deadline.completed.isnot(True),
+                    Deadline.next_reminder_at >= now - REMINDER_GRACE,
+                    Deadline.due_date > now
+                ).values(reminders_sent=Deadline.reminders_sent.op('|')(REMINDER_BITS[kind])).returning(
+                    User.telegram_id, Deadline.id.label('deadline_id'),
+                    Deadline.course_name, Deadline.title, Deadline.due_date, Deadline.link
+                ))
+
+            # Also moves reminders missed by more than the grace period along
+            deadline_ids = {deadline_id for _, deadline_id, _ in entries}
+            refresh_next_reminders(db, deadline_ids=deadline_ids)
+            following = db.execute(
+                select(Deadline.next_reminder_at, Deadline.id, Deadline.next_reminder_kind).where(
+                    Deadline.id.in_(deadline_ids),
+                    Deadline.next_reminder_at <= now + REMINDER_HORIZON
                 )
-        except Exception as e:
-            print(f"  ❌ Error syncing user {user.telegram_id}: {e}")
-    
-    db.close()
-    print(f"✅ Auto-sync completed")
+            ).all()
+            db.commit()
+            return queued, [tuple(row) for row in following]
+        finally:
+            db.close()
 
+    async def _fire(self, entries):
+        queued, following = await asyncio.to_thread(self._claim, entries)
+        self._push(following)
+        if queued:
+            wake_delivery()
 
-async def check_and_send_reminders():
-    """Check for upcoming deadlines and send reminders"""
-    print(f"🔔 Checking reminders at {datetime.now()}")
-    
-    db = get_db()
-    now = datetime.utcnow()
-    
-    # Check deadlines for reminders
-    deadlines = db.query(Deadline).filter(
-        Deadline.due_date > now,
-        Deadline.completed == False
-    ).all()
-    
-    for deadline in deadlines:
-        time_until = deadline.due_date - now
-        hours_until = time_until.total_seconds() / 3600
-        
-        user = db.query(User).filter(User.id == deadline.user_id).first()
-        if not user:
-            continue
-            
-        # Get user settings
-        settings = db.query(UserSettings).filter(
-            UserSettings.user_id == user.id
-        ).first()
-        
-        # Default settings if not found
-        if not settings:
-            settings = UserSettings(
-                user_id=user.id,
-                remind_1day=True,
-                remind_3hours=True,
-                remind_1hour=True
-            )
-            db.add(settings)
-        
-        message_sent = False
-        
-        # 1 day reminder (20-28 hours)
-        if settings.remind_1day and not deadline.reminder_1day and 20 <= hours_until <= 28:
-            message = (
-                f"📅 <b>Нагадування за 1 день!</b>\n\n"
-                f"📖 {deadline.course_name}\n"
-                f"📝 {deadline.title}\n"
-                f"⏰ {deadline.due_date.strftime('%d.%m.%Y %H:%M')}\n\n"
-            )
-            if deadline.link:
-                message += f"🔗 <a href='{deadline.link}'>Відкрити в Classroom</a>"
-            
-            deadline.reminder_1day = True
-            message_sent = True
-            
-        # 3 hours reminder (2.5-3.5 hours)
-        elif settings.remind_3hours and not deadline.reminder_3hours and 2.5 <= hours_until <= 3.5:
-            message = (
-                f"⏰ <b>Нагадування за 3 години!</b>\n\n"
-                f"📖 {deadline.course_name}\n"
-                f"📝 {deadline.title}\n"
-                f"⏰ {deadline.due_date.strftime('%d.%m.%Y %H:%M')}\n\n"
-            )
-            if deadline.link:
-                message += f"🔗 <a href='{deadline.link}'>Відкрити в Classroom</a>"
-            
-            deadline.reminder_3hours = True
-            message_sent = True
-            
-        # 1 hour reminder (0.8-1.2 hours)
-        elif settings.remind_1hour and not deadline.reminder_1hour and 0.8 <= hours_until <= 1.2:
-            message = (
-                f"🚨 <b>НАГАДУВАННЯ ЗА 1 ГОДИНУ!</b>\n\n"
-                f"📖 {deadline.course_name}\n"
-                f"📝 {deadline.title}\n"
-                f"⏰ {deadline.due_date.strftime('%d.%m.%Y %H:%M')}\n\n"
-            )
-            if deadline.link:
-                message += f"🔗 <a href='{deadline.link}'>Відкрити в Classroom</a>"
-            
-            deadline.reminder_1hour = True
-            message_sent = True
-        
-        if message_sent and bot_instance:
+    async def run(self):
+        """Fire reminders at their exact times, forever"""
+        while True:
+            self._wakeup.clear()
+            now = datetime.utcnow()
+            due = []
+            while self._heap and self._heap[0][0] <= now + REMINDER_COALESCE:
+                entry = heapq.heappop(self._heap)
+                self._queued.discard(entry)
+                due.append(entry)
+            if due:
+                try:
+                    await self._fire(due)
+                except Exception as e:
+                    print(f"❌ Reminder delivery failed: {e}")
+                continue
+
+            timeout = (self._heap[0][0] - REMINDER_COALESCE - now).total_seconds() if self._heap else None
             try:
-                await bot_instance.send_message(
-                    user.telegram_id,
-                    message,
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                print(f"  ❌ Failed to send reminder to {user.telegram_id}: {e}")
-    
-    db.commit()
-    db.close()
-    print(f"✅ Reminder check completed")
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+reminders = ReminderEngine()
+
+
+async def _on_deadlines_changed(payload):
+    if payload is None:
+        page_cache.clear()
+        await reminders.reload()
+    else:
+        page_cache.invalidate(int(payload))
+        await reminders.refresh_user(int(payload))
+
+
+async def _on_user_changed(payload):
+    if payload is None:
+        identity_cache.clear()
+    else:
+        identity_cache.invalidate(int(payload))
+
+
+async def purge_state():
+    try:
+        removed = await state_store.purge()
+        if removed:
+            print(f"🧹 Purged {removed} bot state entries")
+    except Exception as e:
+        print(f"❌ Error purging bot state: {e}")
+
+
+def _on_sync_requested(scheduler):
+    async def handler(payload):
+        # Run the queue now instead of at the next poll; max_instances keeps one run at a time
+        scheduler.get_job('auto_sync').modify(next_run_time=datetime.now())
+    return handler
 
 
 def start_scheduler():
     """Start the background scheduler"""
     scheduler = AsyncIOScheduler()
     
-    # Auto-sync every 6 hours
+    # Pick up due users from the sync queue (each user has an adaptive interval)
     scheduler.add_job(
         auto_sync_all_users,
-        IntervalTrigger(hours=6),
+        IntervalTrigger(minutes=SYNC_POLL_MINUTES),
         id='auto_sync',
         name='Auto-sync Google Classroom',
         replace_existing=True
     )
     
-    # Check reminders every 30 minutes
+    # Reload reminders; the engine itself sleeps until the next fire time
+    scheduler.add_job(
+        reminders.reload,
+        IntervalTrigger(minutes=REMINDER_RELOAD_MINUTES),
+        id='reload_reminders',
+        name='Reload reminder queue',
+        next_run_time=datetime.now(),
+        replace_existing=True
+    )
+
+    # Drop expired and excess conversation state and course lists
     scheduler.add_job(
-        check_and_send_reminders,
-        IntervalTrigger(minutes=30),
-        id='check_reminders',
-        name='Check and send reminders',
+        purge_state,
+        IntervalTrigger(minutes=STATE_PURGE_MINUTES),
+        id='purge_state',
+        name='Purge bot state',
         replace_existing=True
     )
+    # Keep references: the event loop holds tasks only weakly
+    scheduler.background_tasks = [
+        asyncio.create_task(reminders.run()),
+        asyncio.create_task(run_delivery(list(REMINDERS), _reminder_messages)),
+        asyncio.create_task(listen({
+            DEADLINES_CHANGED: _on_deadlines_changed,
+            SYNC_REQUESTED: _on_sync_requested(scheduler),
+            USER_CHANGED: _on_user_changed
+        }))
+    ]
+    sender.start(bot_instance)
     
     scheduler.start()
     print("✅ Scheduler started")
-    print("  - Auto-sync: every 6 hours")
-    print("  - Reminders: every 30 minutes")
+    print(f"  - Auto-sync: adaptive per user (queue polled every {SYNC_POLL_MINUTES} min)")
+    print(f"  - Reminders: exact fire times (reloaded every {REMINDER_RELOAD_MINUTES} min)")
     
     return scheduler
@@ -0,0 +1,163 @@
+"""
+Bounded key-value state of the bot, with a TTL per entry and LRU eviction:
+- FSM conversations (StateStorage), the course list behind the /courses
+  buttons and the course list found by the last /sync
+- MemoryStateStore keeps entries in the process: at most STATE_MAX_ENTRIES,
+  least recently used evicted first
+- PostgresStateStore keeps them in the bot_state table, so they survive
+  restarts and are shared by bot replicas; expired rows and rows over
+  STATE_MAX_ENTRIES (least recently written first) are removed by purge(),
+  which the scheduler runs periodically
+- STATE_BACKEND=memory|postgres selects the backend, values must be JSON
+"""
+import copy
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+from database import BotState
+from async_db import async_engine
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "50000"))
+# An abandoned /add conversation is forgotten after this long
+FSM_STATE_TTL = timedelta(hours=int(os.getenv("FSM_STATE_TTL_HOURS", "24")))
+COURSES_TTL = timedelta(days=7)
+
+# Namespaces
+FSM = 'fsm'
+COURSES = 'courses'  # telegram_id -> course names in the order of the /courses buttons
+ALL_COURSES = 'all_courses'  # telegram_id -> course names found by the last /sync
+
+
+class MemoryStateStore:
+    """In-process state: not shared between replicas and lost on restart"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (namespace, key) -> (expires_at, value)
+
+    async def get(self, namespace: str, key):
+        entry_key = (namespace, str(key))
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        if datetime.utcnow() >= entry[0]:
+            del self._entries[entry_key]
+            return None
+        self._entries.move_to_end(entry_key)
+        return copy.deepcopy(entry[1])
+
+    async def set(self, namespace: str, key, value, ttl: timedelta):
+        entry_key = (namespace, str(key))
+        self._entries[entry_key] = (datetime.utcnow() + ttl, copy.deepcopy(value))
+        self._entries.move_to_end(entry_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, namespace: str, key):
+        self._entries.pop((namespace, str(key)), None)
+
+    async def purge(self):
+        now = datetime.utcnow()
+        expired = [entry_key for entry_key, (expires_at, _) in self._entries.items() if now >= expires_at]
+        for entry_key in expired:
+            del self._entries[entry_key]
+        return len(expired)
+
+    async def close(self):
+        self._entries.clear()
+
+
+class PostgresStateStore:
+    """State in the bot_state table, one short transaction per call"""
+
+    def __init__(self, engine, max_entries: int):
+        self.engine = engine
+        self.max_entries = max_entries
+
+    async def get(self, namespace: str, key):
+        async with self.engine.connect() as conn:
+            return await conn.scalar(
+                select(BotState.value).where(
+                    BotState.namespace == namespace,
+                    BotState.key == str(key),
+                    BotState.expires_at > datetime.utcnow()
+                )
+            )
+
+    async def set(self, namespace: str, key, value, ttl: timedelta):
+        now = datetime.utcnow()
+        stmt = insert(BotState).values(
+            namespace=namespace, key=str(key), value=value, expires_at=now + ttl, updated_at=now
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['namespace', 'key'],
+            set_={
+                'value': stmt.excluded.value,
+                'expires_at': stmt.excluded.expires_at,
+                'updated_at': stmt.excluded.updated_at
+            }
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt)
+
+    async def delete(self, namespace: str, key):
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(BotState).where(BotState.namespace == namespace, BotState.key == str(key)))
+
+    async def purge(self):
+        async with self.engine.begin() as conn:
+            expired = await conn.execute(delete(BotState).where(BotState.expires_at <= datetime.utcnow()))
+            overflow = await conn.execute(delete(BotState).where(BotState.id.in_(
+                select(BotState.id).order_by(BotState.updated_at.desc()).offset(self.max_entries)
+            )))
+        return expired.rowcount + overflow.rowcount
+
+    async def close(self):
+        pass  # The engine is disposed by async_db.dispose()
+
+
+def create_state_store():
+    if STATE_BACKEND == 'postgres':
+        return PostgresStateStore(async_engine, STATE_MAX_ENTRIES)
+    if STATE_BACKEND == 'memory':
+        return MemoryStateStore(STATE_MAX_ENTRIES)
+    raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+
+
+state_store = create_state_store()
+
+
+class StateStorage(BaseStorage):
+    """aiogram FSM storage on a state store; a conversation expires FSM_STATE_TTL after its last step"""
+
+    def __init__(self, store, ttl: timedelta = FSM_STATE_TTL):
+        self.store = store
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self.store.delete(FSM, self.key_builder.build(key, 'state'))
+        else:
+            await self.store.set(FSM, self.key_builder.build(key, 'state'), state, self.ttl)
+
+    async def get_state(self, key):
+        return await self.store.get(FSM, self.key_builder.build(key, 'state'))
+
+    async def set_data(self, key, data):
+        if not data:
+            await self.store.delete(FSM, self.key_builder.build(key, 'data'))
+        else:
+            await self.store.set(FSM, self.key_builder.build(key, 'data'), dict(data), self.ttl)
+
+    async def get_data(self, key):
+        return await self.store.get(FSM, self.key_builder.build(key, 'data')) or {}
+
+    async def close(self):
+        await self.store.close()
@@ -0,0 +1,273 @@
+"""
+Sync work queue shared by every bot and checker replica:
+- one user_sync_state row per user with a token and auto-sync enabled
+- workers claim due users with SELECT ... FOR UPDATE SKIP LOCKED and
+  hold a time-limited lease while syncing, renewing it as they go
+- a lease left behind by a crashed worker simply expires
+- last_synced_at is shared by every entry point (checker, bot auto-sync,
+  interactive /sync): a user synced recently by one service is skipped
+  by the others
+- each user's next sync is scheduled from an EWMA of the changes found by
+  recent syncs, bounded by the user's settings: busy users and users with
+  a deadline within URGENT_WINDOW are synced often, dormant ones back off
+- while the Google API circuit breaker is open, users are put back
+  untouched and the worker stops claiming until the next run
+"""
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, or_, literal
+from sqlalchemy.dialects.postgresql import insert
+from google.auth.exceptions import RefreshError
+from database import get_db, User, Deadline, UserSettings, UserSyncState
+from classroom_client import CircuitOpenError
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = int(os.getenv("SYNC_LEASE_SECONDS", "300"))
+# Users synced concurrently by one process
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "4"))
+# Retry delay after a failed sync
+RETRY_DELAY = timedelta(minutes=int(os.getenv("SYNC_RETRY_MINUTES", "15")))
+# Interactive /sync is skipped if any service synced the user this recently
+INTERACTIVE_FRESHNESS = timedelta(minutes=int(os.getenv("SYNC_FRESHNESS_MINUTES", "2")))
+
+# Adaptive scheduling, intervals in hours (UserSettings defaults)
+DEFAULT_INTERVAL = 6
+DEFAULT_MIN_INTERVAL = 1
+DEFAULT_MAX_INTERVAL = 24
+# Weight of the latest sync in the change-rate EWMA
+CHANGE_RATE_ALPHA = 0.3
+# The interval is chosen so that one sync finds about this many changes
+TARGET_CHANGES = 1
+# Users with an open deadline this close are synced every min interval
+URGENT_WINDOW = timedelta(hours=48)
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_TOKEN_EXPIRED = 'token_expired'
+STATUS_PAUSED = 'paused'
+
+
+def enqueue_users():
+    """Add queue rows for users that don't have one yet, due immediately"""
+    db = get_db()
+    try:
+        db.execute(
+            insert(UserSyncState).from_select(
+                ['user_id', 'next_sync_at'],
+                select(User.id, literal(datetime.utcnow())).where(User.google_token != None)
+            ).on_conflict_do_nothing(index_elements=[UserSyncState.user_id])
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def claim_users(limit: int):
+    """Lease up to `limit` due users to this worker, returns [(user_id, telegram_id, google_token)]"""
+    now = datetime.utcnow()
+    db = get_db()
+    try:
+        due = select(UserSyncState.id).join(
+            User, User.id == UserSyncState.user_id
+        ).outerjoin(
+            UserSettings, UserSettings.user_id == UserSyncState.user_id
+        ).where(
+            UserSyncState.next_sync_at <= now,
+            or_(UserSyncState.lease_expires_at == None, UserSyncState.lease_expires_at < now),
+            User.google_token != None,
+            or_(UserSettings.auto_sync_enabled == True, UserSettings.id == None)
+        ).order_by(
+            UserSyncState.next_sync_at
+        ).limit(limit).with_for_update(of=UserSyncState, skip_locked=True)
+
+        user_ids = db.execute(
+            update(UserSyncState).where(
+                UserSyncState.id.in_(due.scalar_subquery())
+            ).values(
+                lease_owner=WORKER_ID,
+                lease_expires_at=now + timedelta(seconds=LEASE_SECONDS)
+            ).returning(UserSyncState.user_id)
+        ).scalars().all()
+        db.commit()
+
+        if not user_ids:
+            return []
+        users = db.query(User.id, User.telegram_id, User.google_token).filter(
+            User.id.in_(user_ids)
+        ).all()
+        return [(user.id, user.telegram_id, user.google_token) for user in users]
+    finally:
+        db.close()
+
+
+def lease_user(user_id: int):
+    """
+    Lease one user for an interactive sync.
+    Returns (leased, last_synced_at): leased is False while another worker holds the user.
+    """
+    now = datetime.utcnow()
+    db = get_db()
+    try:
+        db.execute(
+            insert(UserSyncState).values(
+                user_id=user_id, next_sync_at=now
+            ).on_conflict_do_nothing(index_elements=[UserSyncState.user_id])
+        )
+        leased = db.execute(
+            update(UserSyncState).where(
+                UserSyncState.user_id == user_id,
+                or_(UserSyncState.lease_expires_at == None, UserSyncState.lease_expires_at < now)
+            ).values(
+                lease_owner=WORKER_ID,
+                lease_expires_at=now + timedelta(seconds=LEASE_SECONDS)
+            ).returning(UserSyncState.last_synced_at)
+        ).first()
+        db.commit()
+        if leased:
+            return True, leased.last_synced_at
+        last_synced_at = db.query(UserSyncState.last_synced_at).filter(
+            UserSyncState.user_id == user_id
+        ).scalar()
+        return False, last_synced_at
+    finally:
+        db.close()
+
+
+def renew_lease(user_id: int) -> bool:
+    """Extend our lease, returns False if it was lost to another worker"""
+    db = get_db()
+    try:
+        renewed = db.execute(
+            update(UserSyncState).where(
+                UserSyncState.user_id == user_id,
+                UserSyncState.lease_owner == WORKER_ID
+            ).values(
+                lease_expires_at=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+            )
+        ).rowcount
+        db.commit()
+        return renewed > 0
+    finally:
+        db.close()
+
+
+def _adaptive_schedule(db, user_id: int, state, changes: int, now: datetime):
+    """Returns (change_rate, next_sync_at) after a successful sync that found `changes`"""
+    settings = db.query(UserSettings).filter(UserSettings.user_id == user_id).first()
+    interval = (settings and settings.auto_sync_interval) or DEFAULT_INTERVAL
+    min_interval = (settings and settings.auto_sync_min_interval) or DEFAULT_MIN_INTERVAL
+    max_interval = (settings and settings.auto_sync_max_interval) or DEFAULT_MAX_INTERVAL
+
+    if state is None or state.last_synced_at is None or state.change_rate is None:
+        # The first sync imports everything; start from the configured interval
+        change_rate = TARGET_CHANGES * 24 / interval
+    else:
+        days = max((now - state.last_synced_at).total_seconds() / 86400, 1 / 24)
+        change_rate = CHANGE_RATE_ALPHA * changes / days + (1 - CHANGE_RATE_ALPHA) * state.change_rate
+
+    hours = TARGET_CHANGES * 24 / change_rate if change_rate > 0 else max_interval
+    hours = min(max(hours, min_interval), max_interval)
+
+    urgent = db.query(Deadline.id).filter(
+        Deadline.user_id == user_id,
+        Deadline.completed == False,
+        Deadline.due_date >= now,
+        Deadline.due_date <= now + URGENT_WINDOW
+    ).first()
+    if urgent:
+        hours = min_interval
+
+    return change_rate, now + timedelta(hours=hours)
+
+
+def release_lease(user_id: int, status: str = None, next_sync_at: datetime = None, changes: int = 0):
+    """
+    Give the user back to the queue and record the sync result, if any.
+    After a failure the user is due again at next_sync_at; after a
+    successful sync the next one is scheduled from the user's change rate.
+    """
+    now = datetime.utcnow()
+    values = {'lease_owner': None, 'lease_expires_at': None}
+    if status:
+        values.update(next_sync_at=next_sync_at or now, last_sync_status=status)
+    db = get_db()
+    try:
+        if status == STATUS_OK:
+            state = db.query(UserSyncState).filter(UserSyncState.user_id == user_id).first()
+            change_rate, next_sync_at = _adaptive_schedule(db, user_id, state, changes, now)
+            values.update(last_synced_at=now, change_rate=change_rate, next_sync_at=next_sync_at)
+        db.execute(
+            update(UserSyncState).where(
+                UserSyncState.user_id == user_id,
+                UserSyncState.lease_owner == WORKER_ID
+            ).values(**values)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _keep_lease(user_id: int):
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        if not await asyncio.to_thread(renew_lease, user_id):
+            print(f"  ⚠️ Lost sync lease for user {user_id}")
+            return
+
+
+async def run_leased(user_id: int, sync, count_changes=None):
+    """
+    Await sync() while holding the user's lease, then release it with the result.
+    count_changes(result) gives the number of changed deadlines (default: the result itself).
+    Exceptions are re-raised after the status has been recorded.
+    """
+    keeper = asyncio.create_task(_keep_lease(user_id))
+    status, next_sync_at, changes = STATUS_ERROR, datetime.utcnow() + RETRY_DELAY, 0
+    try:
+        result = await sync()
+        status, next_sync_at = STATUS_OK, None
+        changes = count_changes(result) if count_changes else (result or 0)
+        return result
+    except CircuitOpenError as e:
+        # Not the user's fault: retry right after the outage
+        status, next_sync_at = STATUS_PAUSED, e.open_until
+        raise
+    except RefreshError:
+        status = STATUS_TOKEN_EXPIRED
+        raise
+    finally:
+        keeper.cancel()
+        await asyncio.to_thread(release_lease, user_id, status, next_sync_at, changes)
+
+
+async def _sync_leased(user, sync_user) -> bool:
+    """Sync one leased user, returns False if Google API calls are paused"""
+    try:
+        await run_leased(user[0], lambda: sync_user(*user))
+    except CircuitOpenError as e:
+        print(f"  ⏸ Google API paused, user {user[1]} postponed: {e}")
+        return False
+    except Exception as e:
+        print(f"  ❌ Error syncing user {user[1]}: {e}")
+    return True
+
+
+async def process_due_users(sync_user, workers: int = SYNC_WORKERS):
+    """
+    Claim and sync due users until none are left or the Google API is paused.
+    sync_user(user_id, telegram_id, google_token) is an async callable returning
+    the number of changed deadlines. Returns the number of processed users.
+    """
+    await asyncio.to_thread(enqueue_users)
+
+    processed = 0
+    while True:
+        users = await asyncio.to_thread(claim_users, workers)
+        if not users:
+            return processed
+        results = await asyncio.gather(*(_sync_leased(user, sync_user) for user in users))
+        processed += sum(results)
+        if not all(results):
+            return processed
@@ -0,0 +1,97 @@
+"""
+Webhook mode of the bot (BOT_MODE=webhook) instead of long polling:
+- Telegram POSTs updates to WEBHOOK_PATH of an aiohttp app run by every bot
+  replica, so replicas can sit behind a load balancer
+- a request is rejected unless its X-Telegram-Bot-Api-Secret-Token header
+  matches WEBHOOK_SECRET
+- each replica processes at most WEBHOOK_CONCURRENCY updates at a time; an
+  update is acknowledged once it has a slot, while there is none Telegram's
+  request waits, which slows delivery down instead of queueing in memory
+  (Telegram keeps at most WEBHOOK_MAX_CONNECTIONS requests open)
+- GET /health answers load balancer checks
+"""
+import asyncio
+import hmac
+import os
+from aiohttp import web
+from aiogram.types import Update
+
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")  # Public https address, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # 1-256 characters: A-Z, a-z, 0-9, _ and -
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "32"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler:
+    """Feeds verified updates into the dispatcher, at most `concurrency` at a time"""
+
+    def __init__(self, dispatcher, bot, secret: str, concurrency: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = set()  # Updates being processed, awaited by drain()
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self.bot})
+        except ValueError:
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            print(f"❌ Error handling update {update.update_id}: {e}")
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        """Wait for the updates being processed"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def handle_health(request):
+    return web.Response(text="ok")
+
+
+async def run_webhook(dispatcher, bot):
+    """Serve the webhook until cancelled, then finish the accepted updates"""
+    if not WEBHOOK_BASE_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_BASE_URL and WEBHOOK_SECRET")
+
+    handler = WebhookHandler(dispatcher, bot, WEBHOOK_SECRET, WEBHOOK_CONCURRENCY)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    app.router.add_get('/health', handle_health)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host='0.0.0.0', port=WEBHOOK_PORT).start()
+        # Every replica registers the same webhook, which is idempotent
+        await bot.set_webhook(
+            f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        print(f"🌐 Webhook listening on :{WEBHOOK_PORT}{WEBHOOK_PATH} (up to {WEBHOOK_CONCURRENCY} updates at once)")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await handler.drain()
+        await bot.session.close()
@@ -2,134 +2,196 @@ import asyncio
 import os
 from datetime import datetime, timedelta
 from aiogram import Bot
-from database import get_db, User, Deadline
+from sqlalchemy import update
+from database import init_db, get_db, User, Deadline, upsert_deadlines, DEADLINES_CHANGED, SYNC_REQUESTED
 from classroom_api import fetch_all_deadlines
+from sync_queue import process_due_users
+from telegram_sender import sender, pack_messages, html_field
+from outbox import enqueue_marked, wake_delivery, run_delivery
+from db_events import listen, own_backend_pids
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN)
 
+# Как часто checker проверяет очередь синхронизации (интервал каждого пользователя адаптивный)
+SYNC_INTERVAL = timedelta(minutes=30)
+# Сколько дедлайнов копится перед одной пачкой INSERT ... ON CONFLICT
+WRITE_CHUNK_SIZE = int(os.getenv("SYNC_WRITE_CHUNK_SIZE", "500"))
+# Изменения дедлайнов часто идут пачкой (авто-синхронизация бота): ждем и проверяем один раз
+CHECK_DEBOUNCE_SECONDS = 5
 
-async def sync_user_deadlines(user_id: int, telegram_id: int, google_token: str):
-    print(f"🔄 Синхронизация для user {telegram_id}...")
-
-    deadlines_data = fetch_all_deadlines(google_token)
-
-    if not deadlines_data:
-        print(f"⚠️ Нет дедлайнов для user {telegram_id}")
-        return
 
+def _save_user_deadlines(user_id: int, telegram_id: int, google_token: str):
+    """Блокирующая часть синхронизации: дедлайны из Classroom пачками в базу"""
     db = get_db()
     added_count = 0
     updated_count = 0
+    total = 0
+    try:
+        chunk = []
+        for dl_data in fetch_all_deadlines(google_token, telegram_id):
+            chunk.append(dl_data)
+            if len(chunk) >= WRITE_CHUNK_SIZE:
+                added, updated = upsert_deadlines(db, user_id, chunk)
+                added_count += added
+                updated_count += updated
+                total += len(chunk)
+                chunk = []
+        added, updated = upsert_deadlines(db, user_id, chunk)
+        added_count += added
+        updated_count += updated
+        total += len(chunk)
+        db.commit()
+    finally:
+        db.close()
+
+    return added_count, updated_count, total
+
+
+async def sync_user_deadlines(user_id: int, telegram_id: int, google_token: str):
+    print(f"🔄 Синхронизация для user {telegram_id}...")
 
-    for dl_data in deadlines_data:
-        existing = db.query(Deadline).filter(
-            Deadline.external_id == dl_data['external_id']
-        ).first()
-
-        if existing:
-            existing.due_date = dl_data['due_date']
-            existing.title = dl_data['title']
-            existing.link = dl_data['link']
-            existing.notified = False
-            updated_count += 1
-        else:
-            new_deadline = Deadline(
-                user_id=user_id,
-                course_name=dl_data['course_name'],
-                title=dl_data['title'],
-                due_date=dl_data['due_date'],
-                link=dl_data['link'],
-                external_id=dl_data['external_id'],
-                notified=False
-            )
-            db.add(new_deadline)
-            added_count += 1
-
-    db.commit()
-    db.close()
+    # Запросы к Google блокирующие - выполняем вне event loop
+    added_count, updated_count, total = await asyncio.to_thread(
+        _save_user_deadlines, user_id, telegram_id, google_token
+    )
+
+    if not total:
+        print(f"⚠️ Нет дедлайнов для user {telegram_id}")
+        return 0
 
     print(f"✅ User {telegram_id}: добавлено {added_count}, обновлено {updated_count}")
 
-    try:
-        await bot.send_message(
-            telegram_id,
-            f"✅ Синхронізація завершена!\n"
-            f"📝 Додано нових: {added_count}\n"
-            f"🔄 Оновлено: {updated_count}\n\n"
-            f"Використайте /deadlines для перегляду"
-        )
-    except Exception as e:
-        print(f"❌ Не вдалося відправити повідомлення user {telegram_id}: {e}")
+    sender.send(
+        telegram_id,
+        f"✅ Синхронізація завершена!\n"
+        f"📝 Додано нових: {added_count}\n"
+        f"🔄 Оновлено: {updated_count}\n\n"
+        f"Використайте /deadlines для перегляду"
+    )
 
+    return added_count + updated_count
 
-async def check_deadlines():
-    print("🔔 Checking deadlines...")
 
-    db = get_db()
-    now = datetime.utcnow()
-    tomorrow = now + timedelta(hours=24)
+def _deadline_block(deadline, now) -> str:
+    hours_left = (deadline['due_date'] - now).seconds // 3600
+    block = (
+        f"📝 {html_field(deadline['title'])}\n"
+        f"📖 Курс: {html_field(deadline['course_name'])}\n"
+        f"⏰ Дедлайн: {deadline['due_date'].strftime('%d.%m.%Y %H:%M')}\n"
+        f"⏳ Залишилось: {hours_left} годин\n"
+    )
+    if deadline['link']:
+        block += f"🔗 <a href='{deadline['link']}'>Відкрити завдання</a>\n"
+    return block + "\n"
 
-    deadlines = db.query(Deadline).filter(
-        Deadline.due_date >= now,
-        Deadline.due_date <= tomorrow,
-        Deadline.notified == False
-    ).all()
 
-    for deadline in deadlines:
-        user = db.query(User).filter(User.id == deadline.user_id).first()
-        if not user:
-            continue
+def _deadline_messages(deadlines):
+    """Одно уведомление, либо сводка по всем дедлайнам пользователя: [(текст, дедлайны в нем)]"""
+    now = datetime.utcnow()
+    if len(deadlines) == 1:
+        return [(f"⚠️ <b>Нагадування про дедлайн!</b>\n\n" + _deadline_block(deadlines[0], now).rstrip("\n"), deadlines)]
+    return pack_messages(
+        f"⚠️ <b>Нагадування про дедлайни ({len(deadlines)})</b>\n\n",
+        [(deadline, _deadline_block(deadline, now)) for deadline in sorted(deadlines, key=lambda d: d['due_date'])]
+    )
 
-        time_left = deadline.due_date - now
-        hours_left = time_left.seconds // 3600
 
-        message = (
-            f"⚠️ <b>Нагадування про дедлайн!</b>\n\n"
-            f"📝 {deadline.title}\n"
-            f"📖 Курс: {deadline.course_name}\n"
-            f"⏰ Дедлайн: {deadline.due_date.strftime('%d.%m.%Y %H:%M')}\n"
-            f"⏳ Залишилось: {hours_left} годин\n"
-        )
+def _queue_deadline_notifications() -> int:
+    """Отмечает дедлайны ближайших 24 часов и кладёт уведомления в outbox одним запросом"""
+    db = get_db()
+    now = datetime.utcnow()
+    tomorrow = now + timedelta(hours=24)
+    try:
+        queued = enqueue_marked(db, 'notified', update(Deadline.__table__).where(
+            User.id == Deadline.user_id,
+            Deadline.due_date >= now,
+            Deadline.due_date <= tomorrow,
+            Deadline.notified == False
+        ).values(notified=True).returning(
+            User.telegram_id, Deadline.id.label('deadline_id'),
+            Deadline.course_name, Deadline.title, Deadline.due_date, Deadline.link
+        ))
+        db.commit()
+        return queued
+    finally:
+        db.close()
 
-        if deadline.link:
-            message += f"🔗 <a href='{deadline.link}'>Відкрити завдання</a>"
 
-        try:
-            await bot.send_message(user.telegram_id, message, parse_mode="HTML")
-            deadline.notified = True
-            print(f"✅ Уведомление отправлено user {user.telegram_id}")
-        except Exception as e:
-            print(f"❌ Ошибка отправки уведомления: {e}")
+async def check_deadlines():
+    print("🔔 Checking deadlines...")
 
-    db.commit()
-    db.close()
+    # Флаг notified и уведомление записываются в одной транзакции;
+    # доставкой занимается run_delivery, отметка о доставке ставится только после отправки
+    queued = await asyncio.to_thread(_queue_deadline_notifications)
+    print(f"📨 Уведомлений в очереди: {queued}")
+    if queued:
+        wake_delivery()
 
 
 async def sync_all_users():
     print("🔄 Синхронизация всех пользователей...")
 
-    db = get_db()
-    users = db.query(User).filter(User.google_token != None).all()
-    db.close()
+    # Пользователи берутся из общей очереди, поэтому checker можно запускать в нескольких копиях
+    synced = await process_due_users(sync_user_deadlines)
 
-    for user in users:
+    print(f"✅ Синхронизировано пользователей: {synced}")
+
+
+async def wait_next_pass(wake, sync_requested):
+    """
+    Ждет до SYNC_INTERVAL или SYNC_REQUESTED. Изменения дедлайнов из других
+    процессов не требуют синхронизации: по ним только проверяются уведомления
+    """
+    loop = asyncio.get_running_loop()
+    next_pass = loop.time() + SYNC_INTERVAL.total_seconds()
+    while not sync_requested.is_set():
         try:
-            await sync_user_deadlines(user.id, user.telegram_id, user.google_token)
-        except Exception as e:
-            print(f"❌ Ошибка синхронизации user {user.telegram_id}: {e}")
+            await asyncio.wait_for(wake.wait(), next_pass - loop.time())
+        except asyncio.TimeoutError:
+            return
+        if sync_requested.is_set():
+            return
+        await asyncio.sleep(CHECK_DEBOUNCE_SECONDS)
+        wake.clear()
+        await check_deadlines()
 
 
 async def main():
+    # До первого запроса к базе: свои NOTIFY (upsert_deadlines) checker не получает
+    own_pids = own_backend_pids()
+    init_db()
+    sender.start(bot)
+    delivery = asyncio.create_task(run_delivery(['notified'], _deadline_messages))
+
+    # NOTIFY от бота или OAuth-сервера будит checker, не дожидаясь SYNC_INTERVAL
+    wake = asyncio.Event()
+    sync_requested = asyncio.Event()
+
+    async def on_deadlines_changed(payload):
+        wake.set()
+
+    async def on_sync_requested(payload):
+        # None - переподключение: пропущенных пользователей подберет очередь бота, проверяем только уведомления
+        if payload is not None:
+            sync_requested.set()
+        wake.set()
+
+    events = asyncio.create_task(listen(
+        {DEADLINES_CHANGED: on_deadlines_changed, SYNC_REQUESTED: on_sync_requested},
+        ignore_pids=own_pids
+    ))
     print("🔔 Checker started...")
 
     while True:
         try:
+            wake.clear()
+            sync_requested.clear()
             await sync_all_users()
             await check_deadlines()
 
             print("⏰ Следующая проверка через 30 минут...")
-            await asyncio.sleep(1800)
+            await wait_next_pass(wake, sync_requested)
 
         except Exception as e:
             print(f"❌ Ошибка в checker: {e}")
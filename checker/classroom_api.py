@@ -1,103 +1,137 @@
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
 from datetime import datetime
-import os
-
-os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
-
-
-def get_classroom_service(refresh_token: str):
-    credentials = Credentials(
-        None,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.getenv("GOOGLE_CLIENT_ID"),
-        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-        scopes=[
-            'https://www.googleapis.com/auth/classroom.courses.readonly',
-            'https://www.googleapis.com/auth/classroom.course-work.readonly'
-        ]
-    )
-    return build('classroom', 'v1', credentials=credentials)
-
-def fetch_all_deadlines(refresh_token: str):
+from classroom_client import get_client, invalidate_client, execute, execute_batch, CircuitOpenError
+
+# Classroom принимает не больше 50 запросов в одном batch
+BATCH_SIZE = 50
+# Максимальный pageSize для courses.list и courseWork.list
+PAGE_SIZE = 100
+
+
+def _parse_coursework(course, coursework_list):
+    course_id = course['id']
+    course_name = course['name']
+    deadlines = []
+
+    if len(coursework_list) > 0:
+        print(f"📘 Курс '{course_name}': {len(coursework_list)} завдань.")
+
+    for work in coursework_list:
+        work_title = work.get('title', 'Без назви')
+
+        # Проверяем наличие dueDate
+        if 'dueDate' not in work:
+            print(f"  ⚠️ Пропущено '{work_title}' - немає dueDate")
+            print(f"     Доступні поля: {list(work.keys())}")
+            continue
+
+        try:
+            due_date_dict = work.get('dueDate')
+            due_time_dict = work.get('dueTime', {})
+
+            due_date = datetime(
+                due_date_dict['year'],
+                due_date_dict['month'],
+                due_date_dict['day'],
+                due_time_dict.get('hours', 23),
+                due_time_dict.get('minutes', 59)
+            )
+
+            link = work.get('alternateLink', '')
+
+            deadline_data = {
+                'course_name': course_name,
+                'title': work['title'],
+                'due_date': due_date,
+                'link': link,
+                'external_id': f"{course_id}_{work['id']}"
+            }
+
+            deadlines.append(deadline_data)
+            print(f"  ✅ Додано дедлайн '{work_title}' - {due_date.strftime('%d.%m.%Y %H:%M')}")
+
+        except KeyError as e:
+            print(f"  ❌ Помилка парсингу дедлайну '{work_title}': відсутнє поле {e}")
+        except Exception as e:
+            print(f"  ❌ Помилка обробки '{work_title}': {e}")
+
+    return deadlines
+
+
+def _fetch_pages_batch(service, credentials, pages):
+    """
+    Загрузка одной страницы заданий для каждого (course, page_token) из pages
+    одним batch-запросом. Возвращает [(course, deadlines, next_page_token)].
+    """
+    results = []
+
+    def on_response(request_id, response, exception):
+        course, _ = pages[int(request_id)]
+        if exception is not None:
+            # Ошибка одного курса не влияет на остальные
+            print(f"❌ Ошибка при получении заданий курса {course['name']}: {exception}")
+            return
+        deadlines = _parse_coursework(course, response.get('courseWork', []))
+        results.append((course, deadlines, response.get('nextPageToken')))
+
+    requests = {
+        str(idx): service.courses().courseWork().list(
+            courseId=course['id'],
+            pageSize=PAGE_SIZE,
+            pageToken=page_token
+        )
+        for idx, (course, page_token) in enumerate(pages)
+    }
+
+    # Ошибка всего batch (сеть, недоступность Google) прерывает синхронизацию
+    execute_batch(service, credentials, requests, on_response)
+    return results
+
+
+def list_active_courses(service, credentials):
+    courses = []
+    request = service.courses().list(courseStates=['ACTIVE'], pageSize=PAGE_SIZE)
+    while request is not None:
+        courses_response = execute(request, credentials)
+        courses.extend(courses_response.get('courses', []))
+        request = service.courses().list_next(request, courses_response)
+    return courses
+
+
+def fetch_all_deadlines(refresh_token: str, telegram_id: int):
+    """
+    Потоковая загрузка дедлайнов: генератор проходит все страницы
+    courses.list и courseWork.list и отдаёт дедлайны по мере загрузки.
+    """
     try:
-        service = get_classroom_service(refresh_token)
-        courses_response = service.courses().list(
-            courseStates=['ACTIVE'],
-            pageSize=100
-        ).execute()
-
-        courses = courses_response.get('courses', [])
-        all_deadlines = []
+        service, credentials = get_client(refresh_token, telegram_id)
+        courses = list_active_courses(service, credentials)
+        total = 0
 
         print(f"🔍 Знайдено курсів: {len(courses)}")
 
-        for course in courses:
-            course_id = course['id']
-            course_name = course['name']
-
-            try:
-                coursework_response = service.courses().courseWork().list(
-                    courseId=course_id,
-                    pageSize=100
-                ).execute()
-
-                coursework_list = coursework_response.get('courseWork', [])
-
-                if len(coursework_list) > 0:
-                    print(f"📘 Курс '{course_name}': {len(coursework_list)} завдань.")
-
-                for work in coursework_list:
-                    work_title = work.get('title', 'Без назви')
-                    
-                    # Проверяем наличие dueDate
-                    if 'dueDate' not in work:
-                        print(f"  ⚠️ Пропущено '{work_title}' - немає dueDate")
-                        print(f"     Доступні поля: {list(work.keys())}")
-                        continue
-
-                    try:
-                        due_date_dict = work.get('dueDate')
-                        due_time_dict = work.get('dueTime', {})
-
-                        due_date = datetime(
-                            due_date_dict['year'],
-                            due_date_dict['month'],
-                            due_date_dict['day'],
-                            due_time_dict.get('hours', 23),
-                            due_time_dict.get('minutes', 59)
-                        )
-
-                        link = work.get('alternateLink', '')
-
-                        deadline_data = {
-                            'course_name': course_name,
-                            'title': work['title'],
-                            'due_date': due_date,
-                            'link': link,
-                            'external_id': f"{course_id}_{work['id']}"
-                        }
-
-                        all_deadlines.append(deadline_data)
-                        print(f"  ✅ Додано дедлайн '{work_title}' - {due_date.strftime('%d.%m.%Y %H:%M')}")
-                    
-                    except KeyError as e:
-                        print(f"  ❌ Помилка парсингу дедлайну '{work_title}': відсутнє поле {e}")
-                    except Exception as e:
-                        print(f"  ❌ Помилка обробки '{work_title}': {e}")
-
-            except Exception as e:
-                print(f"❌ Ошибка при получении заданий курса {course_name}: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
-
-        print(f"✅ Всього знайдено {len(all_deadlines)} дедлайнів")
-        return all_deadlines
-
+        pending = [(course, None) for course in courses]
+        while pending:
+            next_pending = []
+            for i in range(0, len(pending), BATCH_SIZE):
+                for course, deadlines, next_page_token in _fetch_pages_batch(service, credentials, pending[i:i + BATCH_SIZE]):
+                    total += len(deadlines)
+                    yield from deadlines
+                    if next_page_token:
+                        next_pending.append((course, next_page_token))
+            pending = next_pending
+
+        print(f"✅ Всього знайдено {total} дедлайнів")
+
+    except RefreshError:
+        print(f"❌ Token expired or revoked for user {telegram_id}")
+        invalidate_client(telegram_id)
+        raise
+    except CircuitOpenError:
+        raise
     except Exception as e:
         print(f"❌ Ошибка при получении данных из Classroom: {e}")
         import traceback
         traceback.print_exc()
-        return []
+        # Неполные данные - не успешная синхронизация: очередь повторит ее через RETRY_DELAY
+        raise
@@ -1,6 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, BigInteger
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, BigInteger, Float, UniqueConstraint, Index
+from sqlalchemy import or_, case, literal_column, text
+from sqlalchemy.dialects.postgresql import insert, ARRAY, JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timedelta
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -21,6 +24,19 @@ class User(Base):
 
 class Deadline(Base):
     __tablename__ = "deadlines"
+    __table_args__ = (
+        # Deadline views: a user's deadlines by due date
+        Index('ix_deadlines_user_due', 'user_id', 'due_date'),
+        # Course view and the list of a user's courses
+        Index('ix_deadlines_user_course_due', 'user_id', 'course_name', 'due_date'),
+        # Reminder engine and urgent-deadline check: only incomplete rows
+        Index('ix_deadlines_incomplete_due', 'due_date', postgresql_where=text('completed = false')),
+        Index('ix_deadlines_incomplete_user_due', 'user_id', 'due_date', postgresql_where=text('completed = false')),
+        # Checker: deadlines not yet announced
+        Index('ix_deadlines_unnotified_due', 'due_date', postgresql_where=text('notified = false')),
+        # Reminder engine: reminders due before a given time
+        Index('ix_deadlines_next_reminder', 'next_reminder_at', postgresql_where=text('next_reminder_at IS NOT NULL')),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
@@ -33,13 +49,18 @@ class Deadline(Base):
     # New fields for enhancements
     completed = Column(Boolean, default=False)
     priority = Column(String, default='medium')  # 'low', 'medium', 'high'
-    reminder_1day = Column(Boolean, default=False)  # Reminder sent 1 day before
-    reminder_3hours = Column(Boolean, default=False)  # Reminder sent 3 hours before
-    reminder_1hour = Column(Boolean, default=False)  # Reminder sent 1 hour before
+    # Bitmask of sent reminders, bit i is REMINDER_OFFSETS[i]
+    reminders_sent = Column(Integer, nullable=False, default=0, server_default='0')
+    # Earliest reminder still to be sent, maintained by refresh_next_reminders()
+    next_reminder_at = Column(DateTime, nullable=True)
+    next_reminder_kind = Column(String, nullable=True)  # Kind of that reminder, e.g. 'reminder_1hour'
 
 
 class Coursework(Base):
     __tablename__ = "coursework"
+    __table_args__ = (
+        Index('ix_coursework_user_course', 'user_id', 'course_name'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
@@ -55,15 +76,416 @@ class UserSettings(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, unique=True, nullable=False)
     auto_sync_enabled = Column(Boolean, default=True)
-    auto_sync_interval = Column(Integer, default=6)  # hours
-    remind_1day = Column(Boolean, default=True)
-    remind_3hours = Column(Boolean, default=True)
-    remind_1hour = Column(Boolean, default=True)
+    auto_sync_interval = Column(Integer, default=6)  # hours, starting interval for adaptive sync
+    auto_sync_min_interval = Column(Integer, default=1)  # hours
+    auto_sync_max_interval = Column(Integer, default=24)  # hours
+    # Minutes before the due date to remind at, chosen from REMINDER_OFFSETS;
+    # NULL means DEFAULT_REMINDER_OFFSETS, an empty list turns reminders off
+    reminder_offsets = Column(ARRAY(Integer), nullable=True)
+
+
+class CourseSyncState(Base):
+    """Per-user, per-course watermark for incremental sync"""
+    __tablename__ = "course_sync_state"
+    __table_args__ = (UniqueConstraint('user_id', 'course_id'),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    course_id = Column(String, nullable=False)
+    course_update_time = Column(DateTime, nullable=True)  # Course.updateTime at last sync
+    coursework_update_time = Column(DateTime, nullable=True)  # Latest CourseWork.updateTime seen
+    full_synced_at = Column(DateTime, nullable=True)  # Last full sync; deletions are only seen by a full one
+
+
+class UserSyncState(Base):
+    """Sync work queue entry: when the user is due and which worker holds the lease"""
+    __tablename__ = "user_sync_state"
+    __table_args__ = (
+        Index('ix_user_sync_state_next_sync', 'next_sync_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, unique=True, nullable=False)
+    next_sync_at = Column(DateTime, nullable=False)  # Adaptive due time, or retry / outage delay
+    lease_owner = Column(String, nullable=True)  # Worker id, e.g. "hostname:pid"
+    lease_expires_at = Column(DateTime, nullable=True)
+    last_synced_at = Column(DateTime, nullable=True)  # Last successful sync by any service
+    last_sync_status = Column(String, nullable=True)  # 'ok', 'error', 'token_expired', 'paused'
+    change_rate = Column(Float, nullable=True)  # EWMA of changed deadlines per day
+
+
+class ApiQuotaState(Base):
+    """Token bucket and circuit breaker shared by every process calling a Google API"""
+    __tablename__ = "api_quota_state"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)  # e.g. 'classroom'
+    tokens = Column(Float, nullable=False)
+    refilled_at = Column(DateTime, nullable=False)
+    failures = Column(Integer, default=0)  # Consecutive 429/5xx responses
+    open_until = Column(DateTime, nullable=True)  # Circuit breaker: no calls before this time
+
+
+class NotificationOutbox(Base):
+    """Notifications waiting for delivery; written together with the flag that triggered them"""
+    __tablename__ = "notification_outbox"
+    __table_args__ = (
+        Index(
+            'ix_notification_outbox_pending', 'available_at', 'telegram_id',
+            postgresql_where=text('delivered_at IS NULL AND failed = false')
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column(String, unique=True, nullable=False)  # e.g. "reminder_1hour:42:202610182359"
+    kind = Column(String, nullable=False)  # Reminder kind or Deadline flag that produced it, e.g. 'reminder_1hour', 'notified'
+    telegram_id = Column(BigInteger, nullable=False)
+    deadline_id = Column(Integer, nullable=True)
+    course_name = Column(String, nullable=True)
+    title = Column(String, nullable=True)
+    due_date = Column(DateTime, nullable=True)
+    link = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    available_at = Column(DateTime, nullable=False)  # Not delivered before this time (retry delay)
+    attempts = Column(Integer, default=0)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    failed = Column(Boolean, default=False)  # Gave up after OUTBOX_MAX_ATTEMPTS
+
+
+class BotState(Base):
+    """Bot conversation state and per-user caches shared by bot replicas (state_store.PostgresStateStore)"""
+    __tablename__ = "bot_state"
+    __table_args__ = (
+        UniqueConstraint('namespace', 'key'),
+        Index('ix_bot_state_expires', 'expires_at'),
+        Index('ix_bot_state_updated', 'updated_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    namespace = Column(String, nullable=False)  # e.g. 'fsm', 'courses'
+    key = Column(String, nullable=False)
+    value = Column(JSONB, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)  # Least recently written rows are evicted first
+
+
+# LISTEN/NOTIFY channels between services, the payload is a users.id
+DEADLINES_CHANGED = 'deadlines_changed'  # Reminder timers of the user need re-evaluation
+SYNC_REQUESTED = 'sync_requested'  # The user should be synced now, e.g. a newly connected account
+USER_CHANGED = 'user_changed'  # The user's Google token was set or cleared
+
+
+def notify(db, channel: str, user_id: int):
+    """Queue a NOTIFY; Postgres delivers it to listeners when the transaction commits"""
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': channel, 'payload': str(user_id)})
+
+
+# Reminder offsets users can choose: (kind, offset before the due date).
+# The position is the bit in Deadline.reminders_sent, so only append.
+REMINDER_OFFSETS = [
+    ('reminder_1day', timedelta(days=1)),
+    ('reminder_3hours', timedelta(hours=3)),
+    ('reminder_1hour', timedelta(hours=1)),
+    ('reminder_7days', timedelta(days=7)),
+    ('reminder_3days', timedelta(days=3)),
+    ('reminder_2days', timedelta(days=2)),
+    ('reminder_12hours', timedelta(hours=12)),
+    ('reminder_6hours', timedelta(hours=6)),
+    ('reminder_2hours', timedelta(hours=2)),
+    ('reminder_30min', timedelta(minutes=30)),
+    ('reminder_15min', timedelta(minutes=15)),
+]
+REMINDER_BITS = {kind: 1 << bit for bit, (kind, _) in enumerate(REMINDER_OFFSETS)}
+# Minutes, for users without a reminder_offsets setting
+DEFAULT_REMINDER_OFFSETS = [24 * 60, 3 * 60, 60]
+# A reminder missed by more than this (bot was down, deadline added late) is skipped
+REMINDER_GRACE = timedelta(minutes=30)
+
+# For each selected deadline, the earliest reminder among the user's offsets
+# that is not sent and not missed by more than the grace period; NULL when none is left
+_NEXT_REMINDER_SQL = """
+    UPDATE deadlines AS d
+    SET next_reminder_at = r.fire_at, next_reminder_kind = r.kind
+    FROM deadlines AS src
+    LEFT JOIN user_settings AS s ON s.user_id = src.user_id
+    LEFT JOIN LATERAL (
+        SELECT k.kind, src.due_date - make_interval(mins => k.minutes) AS fire_at
+        FROM (VALUES {kinds}) AS k(kind, bit, minutes)
+        WHERE src.completed IS NOT TRUE
+          AND src.due_date > :now
+          AND src.reminders_sent & k.bit = 0
+          AND k.minutes = ANY(COALESCE(s.reminder_offsets, CAST(:defaults AS INTEGER[])))
+          AND src.due_date - make_interval(mins => k.minutes) >= :now - make_interval(secs => :grace)
+        ORDER BY fire_at
+        LIMIT 1
+    ) AS r ON true
+    WHERE d.id = src.id
+      AND {where}
+      AND (d.next_reminder_at IS DISTINCT FROM r.fire_at OR d.next_reminder_kind IS DISTINCT FROM r.kind)
+"""
+
+
+def refresh_next_reminders(db, user_id: int = None, deadline_ids=None):
+    """
+    Recompute next_reminder_at / next_reminder_kind after deadlines, sent bits
+    or reminder offsets change. Limited to one user or to deadline_ids;
+    without either every deadline is recomputed. The caller commits.
+    """
+    kinds = ", ".join(
+        f"('{kind}', {REMINDER_BITS[kind]}, {int(offset.total_seconds()) // 60})"
+        for kind, offset in REMINDER_OFFSETS
+    )
+    params = {
+        'now': datetime.utcnow(),
+        'grace': REMINDER_GRACE.total_seconds(),
+        'defaults': DEFAULT_REMINDER_OFFSETS
+    }
+    if deadline_ids is not None:
+        if not deadline_ids:
+            return
+        where = "src.id = ANY(:ids)"
+        params['ids'] = list(deadline_ids)
+    elif user_id is not None:
+        where = "src.user_id = :user_id"
+        params['user_id'] = user_id
+    else:
+        where = "true"
+    db.execute(text(_NEXT_REMINDER_SQL.format(kinds=kinds, where=where)), params)
+
+
+# Columns added to existing tables after the first release: (table, column, type)
+_ADDED_COLUMNS = [
+    ('user_settings', 'auto_sync_min_interval', 'INTEGER DEFAULT 1'),
+    ('user_settings', 'auto_sync_max_interval', 'INTEGER DEFAULT 24'),
+    ('user_sync_state', 'last_synced_at', 'TIMESTAMP'),
+    ('user_sync_state', 'last_sync_status', 'VARCHAR'),
+    ('user_sync_state', 'change_rate', 'DOUBLE PRECISION'),
+]
+
+
+def _create_indexes(conn, names):
+    """Create the model indexes with the given names if they don't exist yet"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                index.create(bind=conn, checkfirst=True)
+
+
+def _migration_1(conn):
+    """New columns on existing tables and indexes for the hot query paths"""
+    for table, column, column_type in _ADDED_COLUMNS:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}"))
+    _create_indexes(conn, [
+        'ix_deadlines_user_due', 'ix_deadlines_user_course_due', 'ix_deadlines_incomplete_due',
+        'ix_deadlines_incomplete_user_due', 'ix_deadlines_unnotified_due', 'ix_coursework_user_course',
+        'ix_user_sync_state_next_sync', 'ix_notification_outbox_pending',
+    ])
+
+
+def _migration_2(conn):
+    """Precomputed next reminder per deadline, filled in by migration 3"""
+    conn.execute(text("ALTER TABLE deadlines ADD COLUMN IF NOT EXISTS next_reminder_at TIMESTAMP"))
+    conn.execute(text("ALTER TABLE deadlines ADD COLUMN IF NOT EXISTS next_reminder_kind VARCHAR"))
+    _create_indexes(conn, ['ix_deadlines_next_reminder'])
+
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return conn.execute(text(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = :table AND column_name = :column"
+    ), {'table': table, 'column': column}).first() is not None
+
+
+def _migration_3(conn):
+    """Reminder flags and switches become a sent bitmask and a list of offsets"""
+    conn.execute(text("ALTER TABLE deadlines ADD COLUMN IF NOT EXISTS reminders_sent INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS reminder_offsets INTEGER[]"))
+    # Databases created before this version; the first three offsets keep their old meaning
+    if _has_column(conn, 'deadlines', 'reminder_1day'):
+        conn.execute(text("""
+            UPDATE deadlines
+            SET reminders_sent = (reminder_1day IS TRUE)::int
+                               | ((reminder_3hours IS TRUE)::int << 1)
+                               | ((reminder_1hour IS TRUE)::int << 2)
+            WHERE reminder_1day OR reminder_3hours OR reminder_1hour
+        """))
+        conn.execute(text("""
+            UPDATE user_settings
+            SET reminder_offsets = array_remove(ARRAY[
+                CASE WHEN remind_1day IS NOT FALSE THEN 1440 END,
+                CASE WHEN remind_3hours IS NOT FALSE THEN 180 END,
+                CASE WHEN remind_1hour IS NOT FALSE THEN 60 END
+            ], NULL)
+            WHERE remind_1day IS FALSE OR remind_3hours IS FALSE OR remind_1hour IS FALSE
+        """))
+        for table, column in [
+            ('deadlines', 'reminder_1day'), ('deadlines', 'reminder_3hours'), ('deadlines', 'reminder_1hour'),
+            ('user_settings', 'remind_1day'), ('user_settings', 'remind_3hours'), ('user_settings', 'remind_1hour'),
+        ]:
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+    refresh_next_reminders(conn)
+
+
+def _migration_4(conn):
+    """Time of the last full sync per course, so deleted coursework is eventually pruned"""
+    conn.execute(text("ALTER TABLE course_sync_state ADD COLUMN IF NOT EXISTS full_synced_at TIMESTAMP"))
+
+
+# Schema migrations in order; each runs once, recorded in schema_version.
+# create_all only creates missing tables: a column added to an existing model
+# needs its ALTER here in the same change, migrate() refuses to start without it
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+]
+
+# Serializes migrations of services starting at the same time
+_MIGRATION_LOCK_ID = 4242001
+
+
+def _missing_columns(conn):
+    """Model columns the database does not have, as 'table.column'"""
+    existing = set(conn.execute(text(
+        "SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = current_schema()"
+    )).all())
+    return [
+        f"{table.name}.{column.name}"
+        for table in Base.metadata.sorted_tables
+        for column in table.columns
+        if (table.name, column.name) not in existing
+    ]
+
+
+def migrate():
+    """Create missing tables and apply pending migrations under a Postgres advisory lock"""
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {'id': _MIGRATION_LOCK_ID})
+        Base.metadata.create_all(bind=conn)
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        current = conn.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+        for version, migration in MIGRATIONS:
+            if version > current:
+                print(f"🛠 Applying schema migration {version}")
+                migration(conn)
+                conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {'version': version})
+        missing = _missing_columns(conn)
+        if missing:
+            # Fail at startup instead of on the first query touching the column
+            raise RuntimeError(f"Columns missing from the database, add a migration: {', '.join(missing)}")
 
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    migrate()
 
 
 def get_db():
     return SessionLocal()
+
+
+def _last_by_external_id(rows):
+    """
+    One row per external_id, the last occurrence wins. ON CONFLICT DO UPDATE
+    cannot touch a row twice in one statement, and paging by updateTime can
+    return an item edited mid-sync twice.
+    """
+    return list({row['external_id']: row for row in rows}.values())
+
+
+def upsert_deadlines(db, user_id: int, deadlines_data):
+    """
+    Bulk INSERT ... ON CONFLICT (external_id) DO UPDATE for synced deadlines.
+    Rows whose fields did not change are not rewritten. Returns (added, updated).
+    """
+    if not deadlines_data:
+        return 0, 0
+    deadlines_data = _last_by_external_id(deadlines_data)
+
+    stmt = insert(Deadline).values([
+        {
+            'user_id': user_id,
+            'course_name': dl['course_name'],
+            'title': dl['title'],
+            'due_date': dl['due_date'],
+            'link': dl['link'],
+            'external_id': dl['external_id'],
+            'notified': False
+        }
+        for dl in deadlines_data
+    ])
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Deadline.external_id],
+        set_={
+            'course_name': excluded.course_name,
+            'title': excluded.title,
+            'due_date': excluded.due_date,
+            'link': excluded.link,
+            # A moved deadline should be announced and reminded about again
+            'notified': case(
+                (Deadline.due_date.is_distinct_from(excluded.due_date), False),
+                else_=Deadline.notified
+            ),
+            'reminders_sent': case(
+                (Deadline.due_date.is_distinct_from(excluded.due_date), 0),
+                else_=Deadline.reminders_sent
+            )
+        },
+        where=or_(
+            Deadline.course_name.is_distinct_from(excluded.course_name),
+            Deadline.title.is_distinct_from(excluded.title),
+            Deadline.due_date.is_distinct_from(excluded.due_date),
+            Deadline.link.is_distinct_from(excluded.link)
+        )
+    ).returning(Deadline.id, literal_column('xmax = 0'))
+
+    # Only inserted and actually updated rows are returned; xmax = 0 means inserted
+    rows = db.execute(stmt).all()
+    if rows:
+        refresh_next_reminders(db, deadline_ids=[row[0] for row in rows])
+        notify(db, DEADLINES_CHANGED, user_id)
+    added_count = sum(row[1] for row in rows)
+    return added_count, len(rows) - added_count
+
+
+def upsert_coursework(db, user_id: int, coursework_data):
+    """Bulk INSERT ... ON CONFLICT (external_id) DO UPDATE for coursework without a due date"""
+    if not coursework_data:
+        return
+    coursework_data = _last_by_external_id(coursework_data)
+
+    stmt = insert(Coursework).values([
+        {
+            'user_id': user_id,
+            'course_name': cw['course_name'],
+            'title': cw['title'],
+            'link': cw['link'],
+            'external_id': cw['external_id']
+        }
+        for cw in coursework_data
+    ])
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Coursework.external_id],
+        set_={
+            'course_name': excluded.course_name,
+            'title': excluded.title,
+            'link': excluded.link
+        },
+        where=or_(
+            Coursework.course_name.is_distinct_from(excluded.course_name),
+            Coursework.title.is_distinct_from(excluded.title),
+            Coursework.link.is_distinct_from(excluded.link)
+        )
+    )
+    db.execute(stmt)
+
+
+def prune_coursework(db, user_id: int, keep_ids, scope):
+    """Delete the user's coursework rows matching `scope` whose external_id is not in keep_ids"""
+    query = db.query(Coursework).filter(Coursework.user_id == user_id, scope)
+    if keep_ids:
+        query = query.filter(Coursework.external_id.notin_(list(keep_ids)))
+    return query.delete(synchronize_session=False)
@@ -0,0 +1,95 @@
+"""
+Postgres LISTEN/NOTIFY wake-ups shared by the bot and the checker.
+
+Writers call database.notify() inside their transaction; Postgres delivers
+the event to every listener once it commits. listen() keeps one dedicated
+connection per process and dispatches each payload to its channel handler:
+- the socket is watched with loop.add_reader, no thread and no polling
+- after a (re)connect every handler is called with None, since events sent
+  while the connection was down are lost
+- poll intervals stay as they are; events only make workers react sooner
+- own_backend_pids() lets a process ignore the events its own writes sent
+"""
+import asyncio
+import os
+import psycopg2
+import psycopg2.extensions
+from sqlalchemy import event
+from database import engine
+
+RECONNECT_DELAY = int(os.getenv("DB_EVENTS_RECONNECT_DELAY", "5"))  # seconds
+
+
+def _connect(channels):
+    dsn = engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+    conn = psycopg2.connect(dsn, keepalives=1, keepalives_idle=60, keepalives_interval=10, keepalives_count=3)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cursor:
+        for channel in channels:
+            cursor.execute(f'LISTEN "{channel}"')
+    return conn
+
+
+def own_backend_pids():
+    """
+    Live set of Postgres backend pids of this process's pool connections, the
+    `pid` of every notification they send
+    """
+    pids = set()
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['backend_pid'] = dbapi_connection.get_backend_pid()
+        pids.add(connection_record.info['backend_pid'])
+
+    @event.listens_for(engine, 'close')
+    def on_close(dbapi_connection, connection_record):
+        pids.discard(connection_record.info.pop('backend_pid', None))
+
+    return pids
+
+
+async def _dispatch(handlers, channel, payload):
+    try:
+        await handlers[channel](payload)
+    except Exception as e:
+        print(f"❌ Handler for {channel} failed: {e}")
+
+
+async def listen(handlers, ignore_pids=frozenset()):
+    """
+    Run forever, calling `await handlers[channel](payload)` for every
+    notification not sent from one of ignore_pids; payload is None after a reconnect
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        conn = None
+        try:
+            conn = await asyncio.to_thread(_connect, list(handlers))
+            print(f"👂 Listening for {', '.join(handlers)}")
+            # A dropped connection no longer reports its fileno()
+            fd = conn.fileno()
+            readable = asyncio.Event()
+            loop.add_reader(fd, readable.set)
+            try:
+                for channel in handlers:
+                    await _dispatch(handlers, channel, None)
+                while True:
+                    await readable.wait()
+                    readable.clear()
+                    conn.poll()
+                    # One write usually touches a user several times, handle each once
+                    events = dict.fromkeys((n.channel, n.payload) for n in conn.notifies if n.pid not in ignore_pids)
+                    conn.notifies.clear()
+                    for channel, payload in events:
+                        await _dispatch(handlers, channel, payload)
+            finally:
+                loop.remove_reader(fd)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ LISTEN connection lost: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        await asyncio.sleep(RECONNECT_DELAY)
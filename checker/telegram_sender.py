@@ -0,0 +1,190 @@
+"""
+Outgoing Telegram message queue shared by the bot and the checker:
+- TELEGRAM_SEND_WORKERS workers deliver messages concurrently
+- global limit of TELEGRAM_GLOBAL_RATE messages per second for this process
+  (the bot and the checker share one token, keep their sum under ~30)
+- at most one message per TELEGRAM_CHAT_INTERVAL seconds to the same chat
+- TelegramRetryAfter puts the message back after retry_after seconds
+  and holds the chat until then
+- qsize() reports the number of messages waiting; a non-empty queue is
+  logged every TELEGRAM_QUEUE_REPORT_SECONDS
+- pack_messages() coalesces several items for one chat into as few
+  messages as Telegram's length limit allows, and tells which items went
+  into which message; html_field() makes user text safe to put into those
+  HTML blocks
+"""
+import asyncio
+import heapq
+import html
+import itertools
+import os
+import time
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "8"))
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # messages per second
+CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))  # seconds between messages to one chat
+# Attempts for network / 5xx errors; RetryAfter is always honoured
+MAX_ATTEMPTS = 3
+
+QUEUE_REPORT_SECONDS = int(os.getenv("TELEGRAM_QUEUE_REPORT_SECONDS", "60"))
+
+# Telegram rejects longer message texts
+MESSAGE_LIMIT = 4096
+# Longest title or course name put into a message block, so any block fits into one message
+FIELD_LIMIT = 300
+
+# Past per-chat slots are pruned once this many chats are tracked
+_CHAT_SLOTS_LIMIT = 10000
+
+
+def html_field(value: str, limit: int = FIELD_LIMIT) -> str:
+    """User text for an HTML message: cut to limit characters before escaping, never inside markup"""
+    if len(value) > limit:
+        value = value[:limit - 1] + "…"
+    return html.escape(value, quote=False)
+
+
+def pack_messages(header: str, blocks, limit: int = MESSAGE_LIMIT):
+    """
+    Join (item, text block) pairs into messages that start with header and fit
+    into limit characters; returns [(text, items in that message)]. Blocks are
+    HTML and never cut, build them from html_field() values
+    """
+    messages = []
+    current, items = header, []
+    for item, block in blocks:
+        if len(current) + len(block) > limit:
+            messages.append((current, items))
+            current, items = header, []
+        current += block
+        items.append(item)
+    messages.append((current, items))
+    return messages
+
+
+class TelegramSender:
+    """Rate-limited delivery queue for bot.send_message"""
+
+    def __init__(self, workers: int = SEND_WORKERS, rate: float = GLOBAL_RATE, chat_interval: float = CHAT_INTERVAL):
+        self.bot = None
+        self.workers = workers
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self._heap = []  # (ready_at, seq, message)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._next_global = 0.0
+        self._next_chat = {}
+        self._undelivered = 0  # Queued or being sent
+
+    def start(self, bot):
+        """Start the workers; must be called from the running event loop"""
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._report()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def qsize(self) -> int:
+        """Messages not sent yet, including those a worker is about to send"""
+        return self._undelivered
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(QUEUE_REPORT_SECONDS)
+            if self._undelivered:
+                print(f"📬 Telegram queue: {self.qsize()} messages waiting")
+
+    def send(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """
+        Queue a message. The returned future resolves to True once it is
+        delivered or False if delivery failed; awaiting it is optional.
+        """
+        message = {
+            'chat_id': chat_id,
+            'text': text,
+            'kwargs': kwargs,
+            'attempt': 0,
+            'future': asyncio.get_running_loop().create_future()
+        }
+        self._undelivered += 1
+        self._push(message, time.monotonic())
+        return message['future']
+
+    def _push(self, message, ready_at: float):
+        heapq.heappush(self._heap, (ready_at, next(self._seq), message))
+        self._wakeup.set()
+
+    async def _take(self):
+        """Wait for the next message whose chat may receive it now"""
+        while True:
+            now = time.monotonic()
+            if self._heap and self._heap[0][0] <= now:
+                _, _, message = heapq.heappop(self._heap)
+                chat_ready = self._next_chat.get(message['chat_id'], 0.0)
+                if chat_ready > now:
+                    self._push(message, chat_ready)
+                    continue
+                self._reserve_chat(message['chat_id'], now + self.chat_interval)
+                return message
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _reserve_chat(self, chat_id: int, until: float):
+        self._next_chat[chat_id] = until
+        if len(self._next_chat) > _CHAT_SLOTS_LIMIT:
+            now = time.monotonic()
+            self._next_chat = {chat: ready for chat, ready in self._next_chat.items() if ready > now}
+
+    async def _global_slot(self):
+        """Space sends 1/rate seconds apart across all workers"""
+        now = time.monotonic()
+        slot = max(now, self._next_global)
+        self._next_global = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _worker(self):
+        while True:
+            message = await self._take()
+            await self._global_slot()
+            message['attempt'] += 1
+            try:
+                await self.bot.send_message(message['chat_id'], message['text'], **message['kwargs'])
+            except TelegramRetryAfter as e:
+                ready_at = time.monotonic() + e.retry_after
+                print(f"  ⏳ Flood control for {message['chat_id']}, retry in {e.retry_after}s")
+                self._reserve_chat(message['chat_id'], ready_at)
+                self._push(message, ready_at)
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if message['attempt'] < MAX_ATTEMPTS:
+                    self._push(message, time.monotonic() + 2 ** message['attempt'])
+                    continue
+                print(f"  ❌ Failed to send message to {message['chat_id']}: {e}")
+                self._resolve(message, False)
+                continue
+            except Exception as e:
+                print(f"  ❌ Failed to send message to {message['chat_id']}: {e}")
+                self._resolve(message, False)
+                continue
+            self._resolve(message, True)
+
+    def _resolve(self, message, delivered: bool):
+        self._undelivered -= 1
+        if not message['future'].done():
+            message['future'].set_result(delivered)
+
+
+sender = TelegramSender()
@@ -1,7 +1,8 @@
 from aiohttp import web
 import os
 from google_auth_oauthlib.flow import Flow
-from database import init_db, get_db, User, Deadline
+from datetime import datetime
+from database import init_db, get_db, User, Deadline, Coursework, CourseSyncState, UserSyncState, notify, SYNC_REQUESTED, DEADLINES_CHANGED, USER_CHANGED
 
 os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 
@@ -48,9 +49,21 @@ async def handle_callback(request):
     if user:
         # Удаляем старые дедлайны при переподключении нового аккаунта
         db.query(Deadline).filter(Deadline.user_id == user.id).delete()
+        db.query(Coursework).filter(Coursework.user_id == user.id).delete()
+        # Новый аккаунт: сбрасываем watermarks и свежесть, чтобы следующая синхронизация была полной
+        db.query(CourseSyncState).filter(CourseSyncState.user_id == user.id).delete()
+        db.query(UserSyncState).filter(UserSyncState.user_id == user.id).update(
+            {'last_synced_at': None, 'next_sync_at': datetime.utcnow()}, synchronize_session=False
+        )
         
         # Обновляем токен
         user.google_token = credentials.refresh_token
+        # Бот и checker подхватят пользователя сразу, а не на следующем опросе очереди
+        notify(db, SYNC_REQUESTED, user.id)
+        # Дедлайны удалены: бот сбрасывает их напоминания и кеш страниц
+        notify(db, DEADLINES_CHANGED, user.id)
+        # Новый токен: бот обновляет закешированного пользователя
+        notify(db, USER_CHANGED, user.id)
         db.commit()
 
     db.close()